@@ -1,7 +1,7 @@
 # Copyright 2014-2020 Tecnativa - Pedro M. Baeza
 {
     'name': 'Sales commissions',
-    'version': '12.0.3.1.2',
+    'version': '12.0.3.2.0',
     'author': 'Tecnativa,'
               'Odoo Community Association (OCA)',
     'category': 'Sales Management',
@@ -28,10 +28,14 @@
         'views/sale_commission_settlement_view.xml',
         'views/sale_commission_settlement_report.xml',
         'views/report_settlement_templates.xml',
+        'views/sale_commission_settlement_job_views.xml',
+        'views/sale_commission_volume_views.xml',
         'report/sale_commission_analysis_report_view.xml',
         'report/sale_order_commission_analysis_report_view.xml',
         'wizard/wizard_settle.xml',
         'wizard/wizard_invoice.xml',
+        'wizard/wizard_recompute_agents.xml',
+        'data/sale_commission_settlement_job_data.xml',
     ],
     'demo': [
         'demo/sale_agent_demo.xml',
@@ -5,4 +5,7 @@ from . import sale_commission
 from . import res_partner
 from . import sale_order
 from . import account_invoice
+from . import settlement_period
+from . import commission_volume
 from . import settlement
+from . import settlement_job
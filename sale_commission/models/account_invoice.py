@@ -1,6 +1,9 @@
 # Copyright 2014-2018 Tecnativa - Pedro M. Baeza
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+import copy
+from collections import OrderedDict, defaultdict
+
 from odoo import _, api, exceptions, fields, models
 
 
@@ -41,6 +44,14 @@ class AccountInvoice(models.Model):
         settlements.write({'state': 'except_invoice'})
         return super(AccountInvoice, self).action_cancel()
 
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if (('state' in vals or 'date_invoice' in vals) and
+                self.env['sale.commission.volume']._is_volume_used()):
+            self.mapped('invoice_line_ids.agents')._update_volume()
+        return res
+
     def invoice_validate(self):
         """Put settlements associated to the invoices in invoiced state."""
         self.env['sale.commission.settlement'].search(
@@ -96,16 +107,25 @@ class AccountInvoiceLine(models.Model):
         for record in self:
             record.any_settled = any(record.mapped('agents.settled'))
 
-    @api.model
-    def create(self, vals):
-        """Add agents for records created from automations instead of UI."""
-        # We use this form as this is the way it's returned when no real vals
-        agents_vals = vals.get('agents', [(6, 0, [])])
-        invoice_id = vals.get('invoice_id', False)
-        if (agents_vals and agents_vals[0][0] == 6 and not
-                agents_vals[0][2] and invoice_id):
-            vals['agents'] = self._prepare_agents_vals(vals=vals)
-        return super().create(vals)
+    @api.model_create_multi
+    def create(self, vals_list):
+        """Add agents for records created from automations instead of UI.
+
+        Agents are prepared once per invoice, and copied to all its lines.
+        """
+        agents_by_invoice = {}
+        for vals in vals_list:
+            # We use this form as this is the way it's returned when no real
+            # vals
+            agents_vals = vals.get('agents', [(6, 0, [])])
+            invoice_id = vals.get('invoice_id', False)
+            if (agents_vals and agents_vals[0][0] == 6 and not
+                    agents_vals[0][2] and invoice_id):
+                if invoice_id not in agents_by_invoice:
+                    agents_by_invoice[invoice_id] = self._prepare_agents_vals(
+                        vals=vals)
+                vals['agents'] = copy.deepcopy(agents_by_invoice[invoice_id])
+        return super().create(vals_list)
 
     def _prepare_agents_vals(self, vals=None):
         res = super()._prepare_agents_vals(vals=vals)
@@ -158,28 +178,189 @@ class AccountInvoiceLineAgent(models.Model):
         related="object_id.currency_id",
         readonly=True,
     )
+    volume_id = fields.Many2one(
+        comodel_name="sale.commission.volume",
+        string="Agent volume",
+        readonly=True,
+        copy=False,
+        ondelete="set null",
+    )
+    volume_amount = fields.Float(
+        readonly=True,
+        copy=False,
+        help="Amount added by this line to the volume of the agent.",
+    )
 
-    @api.depends('object_id.price_subtotal')
-    def _compute_amount(self):
+    @api.model_create_multi
+    def create(self, vals_list):
+        lines = super().create(vals_list)
+        lines._update_volume()
+        return lines
+
+    @api.multi
+    def write(self, vals):
+        res = super().write(vals)
+        if {'agent', 'object_id', 'commission'} & set(vals):
+            self._update_volume()
+        return res
+
+    @api.multi
+    def unlink(self):
+        deltas = defaultdict(float)
         for line in self:
-            inv_line = line.object_id
-            line.amount = line._get_commission_amount(
-                line.commission, inv_line.price_subtotal,
-                inv_line.product_id, inv_line.quantity,
-            )
+            deltas[line.volume_id.id] -= line.volume_amount
+        res = super().unlink()
+        self.env['sale.commission.volume']._add_amounts(deltas)
+        return res
+
+    @api.depends('object_id.price_subtotal', 'volume_id', 'volume_amount')
+    def _compute_amount(self):
+        amounts = self._get_commission_amounts([
+            (line.commission, line.object_id.price_subtotal,
+             line.object_id.product_id, line.object_id.quantity)
+            for line in self
+        ])
+        for line, amount in zip(self, amounts):
             # Refunds commissions are negative
             if 'refund' in line.invoice.type:
-                line.amount = -line.amount
+                amount = -amount
+            line.amount = amount
+
+    def _get_volume_keys(self):
+        """Get the agent volume period of each line, mapping the dates of
+        all the lines with the same settlement period type at once.
+
+        :return: Dictionary mapping line ids to (agent id, company id,
+          date from, date to) tuples.
+        """
+        calendar = self.env['sale.commission.period']
+        today = fields.Date.context_today(self)
+        lines_by_type = OrderedDict()
+        for line in self:
+            if line.agent.settlement and line.company_id:
+                lines_by_type.setdefault(
+                    line.agent.settlement, []).append(line)
+        res = {}
+        for settlement, lines in lines_by_type.items():
+            indexes, periods = calendar._map_dates_to_periods(
+                settlement, [x.invoice_date or today for x in lines])
+            for line, index in zip(lines, indexes):
+                res[line.id] = (
+                    (line.agent.id, line.company_id.id) + periods[index])
+        return res
+
+    def _update_volume(self):
+        """Register the amount of the lines of validated invoices in the
+        volume of their agent and period. Only the difference with the
+        amount registered before is added, so the rest of lines of the
+        period are neither read nor recomputed.
+
+        Only lines with a volume commission are registered, and the ones
+        registered before are removed from the volume if their commission
+        has changed.
+        """
+        volume_model = self.env['sale.commission.volume']
+        if not self or not volume_model._is_volume_used():
+            return
+        lines = self.exists().filtered(lambda x: not x.settled and (
+            x.volume_id or x.commission.commission_type == 'volume'))
+        if not lines:
+            return
+        keys = lines.filtered(lambda x: (
+            x.commission.commission_type == 'volume' and
+            x.invoice.state in ('open', 'in_payment', 'paid')
+        ))._get_volume_keys()
+        volume_ids = volume_model._get_volume_ids(keys.values())
+        deltas = defaultdict(float)
+        changes = []
+        for line in lines:
+            key = keys.get(line.id)
+            volume_id = volume_ids[key] if key else False
+            amount = line.object_id.price_subtotal_signed if key else 0.0
+            if (volume_id == line.volume_id.id and
+                    amount == line.volume_amount):
+                continue
+            deltas[line.volume_id.id] -= line.volume_amount
+            deltas[volume_id] += amount
+            changes.append((line.id, volume_id or None, amount))
+        if not changes:
+            return
+        volume_model._add_amounts(deltas)
+        ids, volume_ids, amounts = (list(x) for x in zip(*changes))
+        self.env.cr.execute("""
+            UPDATE account_invoice_line_agent aila
+            SET volume_id = c.volume_id, volume_amount = c.amount
+            FROM unnest(%s::int[], %s::int[], %s::float[])
+                AS c(id, volume_id, amount)
+            WHERE aila.id = c.id
+        """, (ids, volume_ids, amounts))
+        changed = self.browse(ids)
+        changed.invalidate_cache(['volume_id', 'volume_amount'], ids)
+        changed.modified(['volume_id', 'volume_amount'])
+        if self.env.recompute and self.env.context.get('recompute', True):
+            self.recompute()
 
-    @api.depends('agent_line', 'agent_line.settlement.state', 'invoice',
-                 'invoice.state')
+    def _get_volume_bases(self, bases):
+        """Use the volume of the agent in the period. Lines not registered
+        in it yet, like the ones of draft invoices, add their amount to the
+        current volume as an estimation.
+        """
+        keys = self.filtered(lambda x: not x.volume_id)._get_volume_keys()
+        volume_ids = self.env['sale.commission.volume']._get_volume_ids(
+            keys.values(), create=False)
+        volumes = {
+            x.id: x.amount for x in
+            self.env['sale.commission.volume'].browse(
+                set(volume_ids.values()))
+        }
+        res = []
+        for line in self:
+            if line.volume_id:
+                res.append(line.volume_id.amount)
+            else:
+                volume_id = volume_ids.get(keys.get(line.id))
+                res.append(
+                    volumes.get(volume_id, 0.0) +
+                    line.object_id.price_subtotal_signed)
+        return res
+
+    @api.depends('agent_line', 'agent_line.settlement')
     def _compute_settled(self):
-        # Count lines of not open or paid invoices as settled for not
-        # being included in settlements
+        # Changes in the state of the settlements are propagated through
+        # `_update_settled`, called from them
         for line in self:
             line.settled = (any(x.settlement.state != 'cancel'
                                 for x in line.agent_line))
 
+    def _update_settled(self):
+        """Refresh the settled flag of the lines with one query, flipping
+        it only on the lines whose value changes.
+        """
+        if not self.ids:
+            return
+        self.env.cr.execute("""
+            UPDATE account_invoice_line_agent aila
+            SET settled = sub.settled
+            FROM (
+                SELECT aila2.id, EXISTS (
+                    SELECT 1
+                    FROM settlement_agent_line_rel rel
+                    JOIN sale_commission_settlement_line scl
+                        ON scl.id = rel.settlement_id
+                    JOIN sale_commission_settlement s
+                        ON s.id = scl.settlement
+                    WHERE rel.agent_line_id = aila2.id
+                        AND s.state != 'cancel'
+                ) AS settled
+                FROM account_invoice_line_agent aila2
+                WHERE aila2.id = ANY(%s)
+            ) AS sub
+            WHERE sub.id = aila.id
+                AND aila.settled IS DISTINCT FROM sub.settled
+        """, (self.ids, ))
+        self.invalidate_cache(['settled'], self.ids)
+        self.modified(['settled'])
+
     @api.depends('object_id', 'object_id.company_id')
     def _compute_company(self):
         for line in self:
@@ -196,10 +377,29 @@ class AccountInvoiceLineAgent(models.Model):
     def _skip_settlement(self):
         """This function should return if the commission can be payed.
 
+        Extend `_get_settleable_ids` for changing it, as settlements are
+        done with it.
+
         :return: bool
         """
         self.ensure_one()
-        return (
-            self.commission.invoice_state == 'paid' and
-            self.invoice.state != 'paid'
-        ) or (self.invoice.state not in ('open', 'paid'))
+        return self.id not in self._get_settleable_ids()
+
+    def _get_settleable_ids(self):
+        """Get the lines whose commission can be payed, evaluated with a
+        single query over the whole recordset.
+
+        :return: Set with the ids of the lines that can be settled.
+        """
+        if not self.ids:
+            return set()
+        self.env.cr.execute("""
+            SELECT aila.id
+            FROM account_invoice_line_agent aila
+            JOIN sale_commission sc ON sc.id = aila.commission
+            JOIN account_invoice ai ON ai.id = aila.invoice
+            WHERE aila.id = ANY(%s)
+                AND ai.state IN ('open', 'paid')
+                AND (sc.invoice_state != 'paid' OR ai.state = 'paid')
+        """, (self.ids, ))
+        return {x[0] for x in self.env.cr.fetchall()}
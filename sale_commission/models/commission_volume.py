@@ -0,0 +1,99 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, fields, models
+
+
+class SaleCommissionVolume(models.Model):
+    _name = "sale.commission.volume"
+    _description = "Accumulated volume of an agent in a settlement period"
+    _order = "date_from desc, agent_id"
+
+    agent_id = fields.Many2one(
+        comodel_name="res.partner", string="Agent", required=True,
+        ondelete="cascade", index=True, readonly=True,
+    )
+    company_id = fields.Many2one(
+        comodel_name="res.company", required=True, ondelete="cascade",
+        readonly=True,
+    )
+    date_from = fields.Date(string="From", required=True, readonly=True)
+    date_to = fields.Date(string="To", required=True, readonly=True)
+    amount = fields.Float(
+        readonly=True,
+        help="Sum of the amounts of the validated invoices of the agent in "
+             "the period, in company currency.",
+    )
+
+    _sql_constraints = [
+        ('period_uniq', 'unique(agent_id, company_id, date_from, date_to)',
+         'There can only be one volume per agent, company and period.'),
+    ]
+
+    @api.model
+    def _is_volume_used(self):
+        """Check if there's any volume commission or registered volume, so
+        the bookkeeping of the volumes can be skipped when there's none.
+        """
+        self.env.cr.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM sale_commission
+                WHERE commission_type = 'volume'
+            ) OR EXISTS (SELECT 1 FROM sale_commission_volume)
+        """)
+        return self.env.cr.fetchone()[0]
+
+    @api.model
+    def _get_volume_ids(self, keys, create=True):
+        """Get the volumes of the given periods with one query, creating the
+        missing ones if asked.
+
+        :param keys: Iterable of (agent id, company id, date from, date to).
+        :return: Dictionary mapping each existing key to the volume id.
+        """
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        columns = [list(x) for x in zip(*keys)]
+        if create:
+            self.env.cr.execute("""
+                INSERT INTO sale_commission_volume (
+                    agent_id, company_id, date_from, date_to, amount,
+                    create_uid, create_date, write_uid, write_date
+                )
+                SELECT k.agent_id, k.company_id, k.date_from, k.date_to,
+                    0.0, %s, now() at time zone 'UTC', %s,
+                    now() at time zone 'UTC'
+                FROM unnest(%s::int[], %s::int[], %s::date[], %s::date[])
+                    AS k(agent_id, company_id, date_from, date_to)
+                ON CONFLICT (agent_id, company_id, date_from, date_to)
+                DO NOTHING
+            """, [self.env.uid, self.env.uid] + columns)
+        self.env.cr.execute("""
+            SELECT v.id, v.agent_id, v.company_id, v.date_from, v.date_to
+            FROM sale_commission_volume v
+            JOIN unnest(%s::int[], %s::int[], %s::date[], %s::date[])
+                AS k(agent_id, company_id, date_from, date_to)
+                ON k.agent_id = v.agent_id
+                AND k.company_id = v.company_id
+                AND k.date_from = v.date_from
+                AND k.date_to = v.date_to
+        """, columns)
+        return {tuple(x[1:]): x[0] for x in self.env.cr.fetchall()}
+
+    @api.model
+    def _add_amounts(self, deltas):
+        """Increase the amount of the volumes in place, so concurrent
+        transactions don't overwrite each other.
+
+        :param deltas: Dictionary mapping volume ids to the amount to add.
+        """
+        deltas = {k: v for k, v in deltas.items() if k and v}
+        if not deltas:
+            return
+        self.env.cr.execute("""
+            UPDATE sale_commission_volume v
+            SET amount = v.amount + d.delta
+            FROM unnest(%s::int[], %s::float[]) AS d(id, delta)
+            WHERE v.id = d.id
+        """, (list(deltas), list(deltas.values())))
+        self.invalidate_cache(['amount'], list(deltas))
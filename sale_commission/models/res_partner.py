@@ -4,6 +4,8 @@
 
 from odoo import api, fields, models
 
+from .sale_commission_mixin import disable_partner_agents_memo
+
 
 class ResPartner(models.Model):
     """Add some fields related to commissions"""
@@ -49,30 +51,161 @@ class ResPartner(models.Model):
             self.agents = self.parent_id.agents
         return res
 
-    @api.model
-    def create(self, vals):
+    @api.model_create_multi
+    def create(self, vals_list):
         """Propagate agents from parent to child"""
-        if (vals.get('parent_id') and not vals.get('agents') and
-                not vals.get('is_company')):
+        vals_to_propagate = [
+            vals for vals in vals_list
+            if (vals.get('parent_id') and not vals.get('agents') and
+                not vals.get('is_company'))
+        ]
+        # Read the agents of all the parents at once
+        parents = self.browse({x['parent_id'] for x in vals_to_propagate})
+        parents.mapped('agents')
+        for vals in vals_to_propagate:
             vals['agents'] = [
                 (4, x) for x in self.browse(vals['parent_id']).agents.ids
             ]
-        return super(ResPartner, self).create(vals)
+        return super(ResPartner, self).create(vals_list)
+
+    def _get_agents_propagation_children(self):
+        """Get the descendant contacts to which the agents of the partners
+        are propagated, with one query for all the levels: active children
+        that are not companies and have no agents or the same agents as
+        their parent.
+
+        :return: List of (partner id, parent id, had agents) tuples, with
+          parents before their children.
+        """
+        self.env.cr.execute("""
+            WITH RECURSIVE children (id, parent_id, had_agents, depth) AS (
+                SELECT c.id, c.parent_id, r.agent_ids != '{}', 1
+                FROM res_partner c, LATERAL (
+                    SELECT ARRAY(
+                        SELECT agent_id FROM partner_agent_rel
+                        WHERE partner_id = c.id ORDER BY agent_id
+                    ) AS agent_ids,
+                    ARRAY(
+                        SELECT agent_id FROM partner_agent_rel
+                        WHERE partner_id = c.parent_id ORDER BY agent_id
+                    ) AS parent_agent_ids
+                ) r
+                WHERE c.parent_id = ANY(%(ids)s)
+                    AND c.active AND NOT COALESCE(c.is_company, FALSE)
+                    AND r.agent_ids IN ('{}', r.parent_agent_ids)
+                UNION ALL
+                SELECT c.id, c.parent_id, r.agent_ids != '{}', ch.depth + 1
+                FROM children ch
+                JOIN res_partner c ON c.parent_id = ch.id, LATERAL (
+                    SELECT ARRAY(
+                        SELECT agent_id FROM partner_agent_rel
+                        WHERE partner_id = c.id ORDER BY agent_id
+                    ) AS agent_ids,
+                    ARRAY(
+                        SELECT agent_id FROM partner_agent_rel
+                        WHERE partner_id = c.parent_id ORDER BY agent_id
+                    ) AS parent_agent_ids
+                ) r
+                WHERE c.active AND NOT COALESCE(c.is_company, FALSE)
+                    AND r.agent_ids IN ('{}', r.parent_agent_ids)
+            )
+            SELECT id, parent_id, had_agents FROM children ORDER BY depth
+        """, {'ids': self.ids})
+        return self.env.cr.fetchall()
+
+    @api.model
+    def _apply_agents_commands(self, agent_ids, commands):
+        """Get the agents resulting of applying the many2many commands to
+        the given ones, or None if they can't be applied without the ORM.
+        """
+        agent_ids = set(agent_ids)
+        for command in commands:
+            if not isinstance(command, (list, tuple)):
+                return None
+            if command[0] == 3:
+                agent_ids.discard(command[1])
+            elif command[0] == 4:
+                agent_ids.add(command[1])
+            elif command[0] == 5:
+                agent_ids.clear()
+            elif command[0] == 6:
+                agent_ids = set(command[2])
+            else:
+                return None
+        return agent_ids
+
+    def _propagate_agents(self, children, commands):
+        """Set the agents of the children found before writing the agents of
+        the partners. Children that had the same agents as their parent
+        get the new agents of the parent, and the ones without agents get
+        the result of applying the commands, as if they were written with
+        them.
+        """
+        empty_result = self._apply_agents_commands([], commands)
+        self.env.cr.execute("""
+            SELECT partner_id, agent_id FROM partner_agent_rel
+            WHERE partner_id = ANY(%s)
+        """, (self.ids, ))
+        results = {x: set() for x in self.ids}
+        for partner_id, agent_id in self.env.cr.fetchall():
+            results[partner_id].add(agent_id)
+        for partner_id, parent_id, had_agents in children:
+            if partner_id not in results:
+                results[partner_id] = (
+                    results[parent_id] if had_agents else empty_result)
+        child_ids = list({x[0] for x in children} - set(self.ids))
+        if not child_ids:
+            return
+        pairs = [(x, y) for x in child_ids for y in results[x]]
+        self.env.cr.execute("""
+            DELETE FROM partner_agent_rel WHERE partner_id = ANY(%s)
+        """, (child_ids, ))
+        if pairs:
+            self.env.cr.execute("""
+                INSERT INTO partner_agent_rel (partner_id, agent_id)
+                SELECT * FROM unnest(%s::int[], %s::int[])
+            """, [list(x) for x in zip(*pairs)])
+        childs = self.browse(child_ids)
+        childs.invalidate_cache(['agents'], child_ids)
+        childs.modified(['agents'])
 
     @api.multi
     def write(self, vals):
         """Propagate agents change in the parent partner to the child
         contacts.
         """
+        children = []
         if vals.get('agents'):
-            for record in self:
-                childs = record.mapped('child_ids').filtered(lambda r: (
-                    (not r.agents or r.agents == record.agents) and
-                    not r.is_company
-                ))
-                if childs:
-                    childs.write({'agents': vals['agents']})
-        return super(ResPartner, self).write(vals)
+            children = self._get_agents_propagation_children()
+            if (children and self._apply_agents_commands(
+                    [], vals['agents']) is None):
+                # Commands creating or editing agents need the ORM, which
+                # propagates them again to the next levels
+                self.browse([
+                    x[0] for x in children if x[1] in self.ids
+                ]).write({'agents': vals['agents']})
+                children = []
+        res = super(ResPartner, self).write(vals)
+        if children:
+            self._propagate_agents(children, vals['agents'])
+        if set(vals) & self._get_agents_memo_fields():
+            self._clear_agents_memo()
+        return res
+
+    @api.multi
+    def unlink(self):
+        res = super().unlink()
+        self._clear_agents_memo()
+        return res
+
+    @api.model
+    def _get_agents_memo_fields(self):
+        """Fields whose change invalidates the memo of default agents."""
+        return {'agents', 'agent', 'commission'}
+
+    @api.model
+    def _clear_agents_memo(self):
+        disable_partner_agents_memo(self.env.cr)
 
     @api.model
     def default_get(self, fields_list):
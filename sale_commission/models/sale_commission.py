@@ -1,5 +1,14 @@
 
-from odoo import api, exceptions, fields, models, _
+from bisect import bisect_right
+from collections import namedtuple
+
+from odoo import api, exceptions, fields, models, tools, _
+
+CompiledCommission = namedtuple('CompiledCommission', [
+    'id', 'commission_type', 'fix_rate', 'amount_base_type',
+    'invoice_state', 'starts', 'ends', 'percents', 'overlapped',
+    'cumulative',
+])
 
 
 class SaleCommission(models.Model):
@@ -9,7 +18,9 @@ class SaleCommission(models.Model):
     name = fields.Char('Name', required=True)
     commission_type = fields.Selection(
         selection=[("fixed", "Fixed percentage"),
-                   ("section", "By sections")],
+                   ("section", "By sections"),
+                   ("progressive", "By progressive sections"),
+                   ("volume", "By period volume sections")],
         string="Type", required=True, default="fixed")
     fix_qty = fields.Float(string="Fixed percentage")
     sections = fields.One2many(
@@ -27,13 +38,133 @@ class SaleCommission(models.Model):
     settlements = fields.Many2many(
         comodel_name='sale.commission.settlement')
 
+    @api.multi
+    @api.constrains('commission_type', 'sections')
+    def _check_progressive_sections(self):
+        for commission in self.filtered(
+                lambda x: x.commission_type == 'progressive'):
+            sections = commission.sections.sorted('amount_from')
+            for section, next_section in zip(sections, sections[1:]):
+                if section.amount_to > next_section.amount_from:
+                    raise exceptions.ValidationError(
+                        _("Progressive sections can't overlap."))
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super().write(vals)
+
+    @api.multi
+    def _get_compiled(self):
+        """Get the compiled representation of the commission, shared by all
+        the transactions of the process.
+
+        :return: `CompiledCommission` tuple.
+        """
+        self.ensure_one()
+        return self._compile(self.write_date)
+
+    @tools.ormcache('self.id', 'write_date')
+    def _compile(self, write_date):
+        """Compile the commission into an immutable object. Sections are
+        sorted by lower limit for fast lookups, except when any of them
+        overlaps the next one. In that case, they are kept in their original
+        order, as the first matching one wins. Progressive sections are
+        always sorted, and the commission of all the previous sections is
+        also accumulated.
+
+        The cache is invalidated on any change of the commission or its
+        sections, which is signalled to the rest of workers.
+        """
+        sections = [
+            (x.amount_from, x.amount_to, x.percent) for x in self.sections
+        ]
+        ordered = sorted(sections, key=lambda x: x[0])
+        # Progressive sections can't overlap, but consecutive ones share
+        # their limit
+        overlapped = self.commission_type != 'progressive' and any(
+            ordered[i][1] >= ordered[i + 1][0]
+            for i in range(len(ordered) - 1)
+        )
+        if not overlapped:
+            sections = ordered
+        cumulative = []
+        total = 0.0
+        for amount_from, amount_to, percent in ordered:
+            cumulative.append(total)
+            total += (amount_to - amount_from) * percent / 100.0
+        return CompiledCommission(
+            id=self.id,
+            commission_type=self.commission_type,
+            fix_rate=self.fix_qty / 100.0,
+            amount_base_type=self.amount_base_type,
+            invoice_state=self.invoice_state,
+            starts=tuple(x[0] for x in sections),
+            ends=tuple(x[1] for x in sections),
+            percents=tuple(x[2] for x in sections),
+            overlapped=overlapped,
+            cumulative=tuple(cumulative),
+        )
+
     @api.multi
     def calculate_section(self, base):
         self.ensure_one()
-        for section in self.sections:
-            if section.amount_from <= base <= section.amount_to:
-                return base * section.percent / 100.0
-        return 0.0
+        return self.calculate_sections([base])[0]
+
+    @api.multi
+    def calculate_sections(self, bases):
+        """Batch version of `calculate_section`, getting the commission
+        amount for each of the given bases.
+        """
+        return [
+            base * percent / 100.0
+            for base, percent in zip(bases, self._get_section_percents(bases))
+        ]
+
+    @api.multi
+    def _get_section_percents(self, bases):
+        """Get the percentage of the section matching each of the given
+        bases, or 0 if there's none.
+        """
+        self.ensure_one()
+        rule = self._get_compiled()
+        starts, ends = rule.starts, rule.ends
+        res = []
+        for base in bases:
+            if rule.overlapped:
+                index = next((
+                    i for i in range(len(starts))
+                    if starts[i] <= base <= ends[i]
+                ), -1)
+            else:
+                index = bisect_right(starts, base) - 1
+                if index >= 0 and base > ends[index]:
+                    index = -1
+            res.append(rule.percents[index] if index >= 0 else 0.0)
+        return res
+
+    @api.multi
+    def calculate_progressive_sections(self, bases):
+        """Get the commission amount for each of the given bases, applying
+        each section percentage only to the part of the base inside it, and
+        adding the whole amount of the previous sections.
+        """
+        self.ensure_one()
+        rule = self._get_compiled()
+        # Progressive sections don't overlap, so they are always sorted
+        starts = rule.starts
+        res = []
+        for base in bases:
+            index = bisect_right(starts, base) - 1
+            if index < 0:
+                res.append(0.0)
+                continue
+            res.append(
+                rule.cumulative[index] +
+                (min(base, rule.ends[index]) - starts[index]) *
+                rule.percents[index] / 100.0
+            )
+        return res
 
     #  @api.multi
     # def calculate_parcial(self, base):
@@ -60,3 +191,19 @@ class SaleCommissionSection(models.Model):
             if section.amount_to < section.amount_from:
                 raise exceptions.ValidationError(
                     _("The lower limit cannot be greater than upper one."))
+        self.mapped('commission')._check_progressive_sections()
+
+    @api.model
+    def create(self, vals):
+        self.clear_caches()
+        return super().create(vals)
+
+    @api.multi
+    def write(self, vals):
+        self.clear_caches()
+        return super().write(vals)
+
+    @api.multi
+    def unlink(self):
+        self.clear_caches()
+        return super().unlink()
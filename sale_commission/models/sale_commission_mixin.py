@@ -1,24 +1,71 @@
 # Copyright 2018 Tecnativa - Pedro M. Baeza
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+from collections import OrderedDict
+
 from odoo import _, api, fields, models
 
+# Key in the cursor cache of the memo of default agents by partner
+PARTNER_AGENTS_MEMO = 'sale_commission.partner_agents'
+
+
+def _reset_partner_agents_memo(cr, memo):
+    """Put the memo of default agents in the cursor cache, making sure it's
+    removed when the transaction ends, as the cursor cache outlives it.
+    """
+    if PARTNER_AGENTS_MEMO not in cr.cache:
+        for event in ('commit', 'rollback'):
+            cr.after(event, lambda: cr.cache.pop(PARTNER_AGENTS_MEMO, None))
+    cr.cache[PARTNER_AGENTS_MEMO] = memo
+
+
+def get_partner_agents_memo(cr):
+    """Get the memo of default agents of the current transaction.
+
+    :return: Dictionary, or None if agents or commissions of partners have
+      been changed in the transaction, as the change may be rolled back to
+      a savepoint and leave stale values in the memo.
+    """
+    if PARTNER_AGENTS_MEMO not in cr.cache:
+        _reset_partner_agents_memo(cr, {})
+    return cr.cache[PARTNER_AGENTS_MEMO]
+
+
+def disable_partner_agents_memo(cr):
+    """Stop memoizing default agents until the end of the transaction."""
+    _reset_partner_agents_memo(cr, None)
+
 
 class SaleCommissionMixin(models.AbstractModel):
     _name = 'sale.commission.mixin'
     _description = "Mixin model for applying to any object that wants to " \
                    "handle commissions"
 
+    @api.model
+    def _get_partner_agents_defaults(self, partner):
+        """Get the agents of a partner with their commissions, memoized in
+        the current transaction unless agents or commissions of partners
+        are changed in it.
+
+        :return: Tuple of (agent id, commission id) tuples.
+        """
+        memo = get_partner_agents_memo(self.env.cr)
+        if memo is None or not isinstance(partner.id, int):
+            return tuple((x.id, x.commission.id) for x in partner.agents)
+        key = (self.env.uid, partner.id)
+        if key not in memo:
+            memo[key] = tuple(
+                (x.id, x.commission.id) for x in partner.agents)
+        return memo[key]
+
     @api.model
     def _prepare_agents_vals_partner(self, partner):
         """Utility method for getting agents of a partner."""
-        rec = []
-        for agent in partner.agents:
-            rec.append((0, 0, {
-                'agent': agent.id,
-                'commission': agent.commission.id,
-            }))
-        return rec
+        return [(0, 0, {
+            'agent': agent_id,
+            'commission': commission_id,
+        }) for agent_id, commission_id in self._get_partner_agents_defaults(
+            partner)]
 
     @api.model
     def _default_agents(self):
@@ -76,11 +123,73 @@ class SaleCommissionMixin(models.AbstractModel):
 
     def recompute_agents(self):
         """Force a recomputation of the agents according prepare method."""
+        self._recompute_agents()
+
+    def _recompute_agents(self):
+        """Recompute the agents of all the records at once, comparing them
+        with the current agent lines, so only the lines that differ are
+        created, updated or deleted. Records with settled agent lines are
+        skipped.
+
+        :return: Dictionary with the number of agent lines created, updated
+          and deleted, and the number of records skipped.
+        """
+        stats = dict.fromkeys(('created', 'updated', 'deleted', 'skipped'), 0)
+        line_model = self.env[self._fields['agents'].comodel_name]
+        to_create = []
+        to_unlink = []
+        to_write = OrderedDict()
         for record in self:
-            record.agents = (
-                [(3, x.id) for x in record.agents] +
-                record._prepare_agents_vals()
-            )
+            if ('settled' in line_model._fields and
+                    any(record.agents.mapped('settled'))):
+                stats['skipped'] += 1
+                continue
+            commands = record._prepare_agents_vals()
+            if any(x[0] not in (0, 5, 6) or (x[0] == 6 and x[2])
+                   for x in commands):
+                # Not a list of new agents, so it can't be compared
+                record.agents = (
+                    [(3, x.id) for x in record.agents] + commands)
+                continue
+            current = list(record.agents)
+            for command in commands:
+                if command[0] != 0:
+                    continue
+                vals = command[2]
+                line = next(
+                    (x for x in current if x.agent.id == vals.get('agent')),
+                    False)
+                if not line:
+                    to_create.append(dict(vals, object_id=record.id))
+                    continue
+                current.remove(line)
+                changes = {}
+                for name, value in vals.items():
+                    old_value = line[name]
+                    if line_model._fields[name].type == 'many2one':
+                        old_value = old_value.id
+                    if old_value != value:
+                        changes[name] = value
+                if not changes:
+                    continue
+                # Lines with the same changes are written together
+                key = tuple(sorted(changes.items()))
+                try:
+                    to_write.setdefault(key, []).append(line.id)
+                except TypeError:
+                    line.write(changes)
+                    stats['updated'] += 1
+            to_unlink += [x.id for x in current]
+        if to_unlink:
+            stats['deleted'] = len(to_unlink)
+            line_model.browse(to_unlink).unlink()
+        for key, line_ids in to_write.items():
+            stats['updated'] += len(line_ids)
+            line_model.browse(line_ids).write(dict(key))
+        if to_create:
+            stats['created'] = len(to_create)
+            line_model.create(to_create)
+        return stats
 
     def button_edit_agents(self):
         self.ensure_one()
@@ -149,17 +258,89 @@ class SaleCommissionLineMixin(models.AbstractModel):
         self.ensure_one()
         if product.commission_free or not commission:
             return 0.0
-        if commission.amount_base_type == 'net_amount':
+        rule = commission._get_compiled()
+        if rule.amount_base_type == 'net_amount':
             # If subtotal (sale_price * quantity) is less than
             # standard_price * quantity, it means that we are selling at
             # lower price than we bought, so set amount_base to 0
             subtotal = max([
                 0, subtotal - product.standard_price * quantity,
             ])
-        if commission.commission_type == 'fixed':
-            return subtotal * (commission.fix_qty / 100.0)
-        elif commission.commission_type == 'section':
+        if rule.commission_type == 'fixed':
+            return subtotal * rule.fix_rate
+        elif rule.commission_type == 'section':
             return commission.calculate_section(subtotal)
+        elif rule.commission_type == 'progressive':
+            return commission.calculate_progressive_sections([subtotal])[0]
+        elif rule.commission_type == 'volume':
+            return self._get_commission_amounts(
+                [(commission, subtotal, product, quantity)])[0]
+
+    def _get_commission_amounts(self, values):
+        """Batch counterpart of `_get_commission_amount` for the whole
+        recordset.
+
+        Lines are grouped by commission, and fixed, section, progressive and
+        volume commissions are computed for each group at once. Other
+        commission types are delegated line by line to
+        `_get_commission_amount`.
+
+        :param values: List of (commission, subtotal, product, quantity)
+          tuples, one per record of self and in the same order.
+        :return: List with the commission amount of each record.
+        """
+        amounts = [0.0] * len(values)
+        groups = OrderedDict()
+        for i, (commission, subtotal, product, quantity) in enumerate(
+                values):
+            if commission:
+                groups.setdefault(commission, []).append(i)
+        for commission, indexes in groups.items():
+            rule = commission._get_compiled()
+            if rule.commission_type not in (
+                    'fixed', 'section', 'progressive', 'volume'):
+                for i in indexes:
+                    amounts[i] = self[i]._get_commission_amount(*values[i])
+                continue
+            indexes = [
+                i for i in indexes if not values[i][2].commission_free
+            ]
+            bases = [values[i][1] for i in indexes]
+            if rule.amount_base_type == 'net_amount':
+                # If subtotal (sale_price * quantity) is less than
+                # standard_price * quantity, it means that we are selling at
+                # lower price than we bought, so set amount_base to 0
+                bases = [
+                    max(0, base - values[i][2].standard_price * values[i][3])
+                    for base, i in zip(bases, indexes)
+                ]
+            if rule.commission_type == 'fixed':
+                results = [base * rule.fix_rate for base in bases]
+            elif rule.commission_type == 'section':
+                results = commission.calculate_sections(bases)
+            elif rule.commission_type == 'progressive':
+                results = commission.calculate_progressive_sections(bases)
+            else:
+                percents = commission._get_section_percents(
+                    self.browse([self._ids[i] for i in indexes])
+                    ._get_volume_bases(bases))
+                results = [
+                    base * percent / 100.0
+                    for base, percent in zip(bases, percents)
+                ]
+            for i, amount in zip(indexes, results):
+                amounts[i] = amount
+        return amounts
+
+    def _get_volume_bases(self, bases):
+        """Get the amounts used for selecting the section of volume
+        commissions, one per record of self. To be extended by children
+        models that keep track of the agents volume. By default, the base of
+        each line is used.
+
+        :param bases: List with the commission base of each record.
+        """
+        return list(bases)
 
     @api.onchange('agent')
     def onchange_agent(self):
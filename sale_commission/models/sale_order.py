@@ -1,6 +1,8 @@
 # Copyright 2014-2019 Tecnativa - Pedro M. Baeza
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+import copy
+
 from odoo import api, fields, models
 from lxml import etree
 
@@ -74,14 +76,25 @@ class SaleOrderLine(models.Model):
         comodel_name="sale.order.line.agent",
     )
 
-    @api.model
-    def create(self, vals):
-        """Add agents for records created from automations instead of UI."""
-        # We use this form as this is the way it's returned when no real vals
-        agents_vals = vals.get('agents', [(6, 0, [])])
-        if agents_vals and agents_vals[0][0] == 6 and not agents_vals[0][2]:
-            vals['agents'] = self._prepare_agents_vals(vals=vals)
-        return super().create(vals)
+    @api.model_create_multi
+    def create(self, vals_list):
+        """Add agents for records created from automations instead of UI.
+
+        Agents are prepared once per order, and copied to all its lines.
+        """
+        agents_by_order = {}
+        for vals in vals_list:
+            # We use this form as this is the way it's returned when no real
+            # vals
+            agents_vals = vals.get('agents', [(6, 0, [])])
+            if (agents_vals and agents_vals[0][0] == 6 and
+                    not agents_vals[0][2]):
+                order_id = vals.get('order_id')
+                if not order_id or order_id not in agents_by_order:
+                    agents_by_order[order_id] = self._prepare_agents_vals(
+                        vals=vals)
+                vals['agents'] = copy.deepcopy(agents_by_order[order_id])
+        return super().create(vals_list)
 
     def _prepare_agents_vals(self, vals=None):
         res = super()._prepare_agents_vals(vals=vals)
@@ -115,9 +128,10 @@ class SaleOrderLineAgent(models.Model):
 
     @api.depends('object_id.price_subtotal')
     def _compute_amount(self):
-        for line in self:
-            order_line = line.object_id
-            line.amount = line._get_commission_amount(
-                line.commission, order_line.price_subtotal,
-                order_line.product_id, order_line.product_uom_qty,
-            )
+        amounts = self._get_commission_amounts([
+            (line.commission, line.object_id.price_subtotal,
+             line.object_id.product_id, line.object_id.product_uom_qty)
+            for line in self
+        ])
+        for line, amount in zip(self, amounts):
+            line.amount = amount
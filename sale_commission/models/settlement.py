@@ -1,6 +1,9 @@
 # Copyright 2014-2018 Tecnativa - Pedro M. Baeza
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+import copy
+from collections import OrderedDict
+
 from odoo import api, exceptions, fields, models, _
 from odoo.exceptions import UserError
 from odoo import tools
@@ -56,13 +59,23 @@ class Settlement(models.Model):
                 _('Cannot cancel an invoiced settlement.'))
         self.write({'state': 'cancel'})
 
+    @api.multi
+    def write(self, vals):
+        res = super(Settlement, self).write(vals)
+        if 'state' in vals:
+            self.mapped('lines.agent_line')._update_settled()
+        return res
+
     @api.multi
     def unlink(self):
         """Allow to delete only cancelled settlements"""
         if any(x.state == 'invoiced' for x in self):
             raise exceptions.Warning(
                 _("You can't delete invoiced settlements."))
-        return super(Settlement, self).unlink()
+        agent_lines = self.mapped('lines.agent_line')
+        res = super(Settlement, self).unlink()
+        agent_lines.exists()._update_settled()
+        return res
 
     @api.multi
     def action_invoice(self):
@@ -76,8 +89,40 @@ class Settlement(models.Model):
             'context': {'settlement_ids': self.ids}
         }
 
-    def _prepare_invoice_header(self, settlement, journal, date=False):
-        invoice = self.env['account.invoice'].new({
+    def _get_onchange_vals(self, model, vals, onchanges, key=None,
+                           cache=None):
+        """Get the values of a new record of `model` after playing the given
+        onchange methods on `vals`.
+
+        :param cache: Optional dictionary where results are memoized by
+          `key` (the values themselves by default), so when making invoices
+          in bulk the onchanges are only played once for each combination.
+        """
+        if key is None:
+            key = tuple(sorted(vals.items()))
+        key = (model, tuple(onchanges), key)
+        if cache is None or key not in cache:
+            record = self.env[model].new(vals)
+            for onchange in onchanges:
+                getattr(record, onchange)()
+            res = record._convert_to_write(record._cache)
+            if cache is None:
+                return res
+            cache[key] = res
+        return copy.deepcopy(cache[key])
+
+    def _get_lang(self, code, cache=None):
+        if cache is None:
+            return self.env['res.lang'].search([('code', '=', code)])
+        key = ('res.lang', code)
+        if key not in cache:
+            cache[key] = self.env['res.lang'].search([('code', '=', code)])
+        return cache[key]
+
+    def _prepare_invoice_header(self, settlement, journal, date=False,
+                                cache=None):
+        # Get other invoice values from onchanges
+        return self._get_onchange_vals('account.invoice', {
             'partner_id': settlement.agent.id,
             'type': ('in_invoice' if journal.type == 'purchase' else
                      'in_refund'),
@@ -85,31 +130,33 @@ class Settlement(models.Model):
             'journal_id': journal.id,
             'company_id': settlement.company_id.id,
             'state': 'draft',
-        })
-        # Get other invoice values from onchanges
-        invoice._onchange_partner_id()
-        invoice._onchange_journal_id()
-        return invoice._convert_to_write(invoice._cache)
-
-    def _prepare_invoice_line(self, settlement, invoice, product):
-        invoice_line = self.env['account.invoice.line'].new({
-            'invoice_id': invoice.id,
-            'product_id': product.id,
-            'quantity': 1,
-        })
-        # Get other invoice line values from product onchange
-
-        invoice_line._onchange_product_id()
-        invoice_line_vals = invoice_line._convert_to_write(invoice_line._cache)
+        }, ['_onchange_partner_id', '_onchange_journal_id'], cache=cache)
+
+    def _prepare_invoice_line(self, settlement, invoice, product,
+                              cache=None):
+        # Get other invoice line values from product onchange. They only
+        # depend on the invoice through these fields
+        invoice_line_vals = self._get_onchange_vals(
+            'account.invoice.line', {
+                'invoice_id': invoice.id,
+                'product_id': product.id,
+                'quantity': 1,
+            }, ['_onchange_product_id'], key=(
+                invoice.partner_id.id, invoice.type, invoice.company_id.id,
+                invoice.currency_id.id, invoice.fiscal_position_id.id,
+                invoice.date_invoice, product.id,
+            ), cache=cache,
+        )
+        invoice_line_vals['invoice_id'] = invoice.id
         # Put commission fee
         if invoice.type == 'in_refund':
             invoice_line_vals['price_unit'] = -settlement.total
         else:
             invoice_line_vals['price_unit'] = settlement.total
         # Put period string
-        lang = self.env['res.lang'].search(
-            [('code', '=', invoice.partner_id.lang or
-              self.env.context.get('lang', 'en_US'))])
+        lang = self._get_lang(
+            invoice.partner_id.lang or self.env.context.get('lang', 'en_US'),
+            cache=cache)
         date_from = fields.Date.from_string(settlement.date_from)
         date_to = fields.Date.from_string(settlement.date_to)
         invoice_line_vals['name'] += "\n" + _('Period: from %s to %s') % (
@@ -124,28 +171,56 @@ class Settlement(models.Model):
         """
         return []
         
-    def create_invoice_header(self, journal, date):
+    def create_invoice_header(self, journal, date, cache=None):
         """Hook that can be used in order to group invoices or
         find open invoices
         """
-        invoice_vals = self._prepare_invoice_header(self, journal, date=date)
+        invoice_vals = self._prepare_invoice_header(
+            self, journal, date=date, cache=cache)
         return self.env['account.invoice'].create(invoice_vals)
 
     @api.multi
-    def make_invoices(self, journal, product, date=False):
+    def make_invoices(self, journal, product, date=False, grouped=False,
+                      cache=None):
+        """Invoice the settlements.
+
+        Onchanges and language lookups are memoized for the whole batch,
+        invoice lines are created with one `create` call for all the
+        invoices and taxes are computed once at the end.
+
+        :param grouped: Make only one invoice per agent and company, with
+          one line per settlement.
+        :param cache: Optional dictionary for the memoized values, to be
+          shared with other calls.
+        """
+        if cache is None:
+            cache = {}
         invoice_line_obj = self.env['account.invoice.line']
+        invoices = OrderedDict()
+        invoice_by_agent = {}
+        lines_vals = []
+        extra_lines_vals = []
         for settlement in self:
             # select the proper journal according to settlement's amount
             # considering _add_extra_invoice_lines sum of values
-            extra_invoice_lines = self._add_extra_invoice_lines(settlement)
-            invoice = settlement.create_invoice_header(journal, date)
-            invoice_line_vals = self._prepare_invoice_line(
-                settlement, invoice, product)
-            invoice_line_obj.create(invoice_line_vals)
-            invoice.compute_taxes()
-            for invoice_line_vals in extra_invoice_lines:
-                invoice_line_obj.create(invoice_line_vals)
-            settlement.write({
+            extra_lines_vals += self._add_extra_invoice_lines(settlement)
+            key = (settlement.agent, settlement.company_id)
+            if grouped and key in invoice_by_agent:
+                invoice = invoice_by_agent[key]
+            else:
+                invoice = settlement.create_invoice_header(
+                    journal, date, cache=cache)
+                invoice_by_agent[key] = invoice
+            lines_vals.append(self._prepare_invoice_line(
+                settlement, invoice, product, cache=cache))
+            invoices.setdefault(invoice, self.browse())
+            invoices[invoice] |= settlement
+        invoice_line_obj.create(lines_vals)
+        self.env['account.invoice'].browse(
+            [x.id for x in invoices]).compute_taxes()
+        invoice_line_obj.create(extra_lines_vals)
+        for invoice, settlements in invoices.items():
+            settlements.write({
                 'state': 'invoiced',
                 'invoice': invoice.id,
             })
@@ -230,6 +305,88 @@ class SettlementLine(models.Model):
                 if line.company_id != record.company_id:
                     raise UserError(_("Company must be the same"))
 
+    @api.model
+    def _create_from_agent_lines(self, agent_lines_by_settlement):
+        """Create in bulk one settlement line per agent line.
+
+        Lines, their relation rows and their stored related fields are
+        written with a handful of queries instead of one `create` per line.
+
+        :param agent_lines_by_settlement: Dictionary with settlement ids as
+          keys and lists of agent line ids as values.
+        :return: Recordset with the created settlement lines.
+        """
+        settlement_ids = []
+        agent_line_ids = []
+        for settlement_id, line_ids in agent_lines_by_settlement.items():
+            settlement_ids += [settlement_id] * len(line_ids)
+            agent_line_ids += line_ids
+        if not agent_line_ids:
+            return self.browse()
+        self.check_access_rights('create')
+        cr = self.env.cr
+        cr.execute("""
+            SELECT 1
+            FROM unnest(%s::int[], %s::int[]) AS data(settlement, agent_line)
+            JOIN sale_commission_settlement s ON s.id = data.settlement
+            JOIN account_invoice_line_agent aila ON aila.id = data.agent_line
+            WHERE aila.company_id IS DISTINCT FROM s.company_id
+            LIMIT 1
+        """, (settlement_ids, agent_line_ids))
+        if cr.fetchone():
+            raise UserError(_("Company must be the same"))
+        cr.execute(
+            "SELECT nextval(%s) FROM generate_series(1, %s)",
+            (self._sequence, len(agent_line_ids)),
+        )
+        ids = [x[0] for x in cr.fetchall()]
+        cr.execute("""
+            INSERT INTO sale_commission_settlement_line
+                (id, settlement, create_uid, create_date, write_uid,
+                 write_date)
+            SELECT data.id, data.settlement, %s, now() at time zone 'UTC',
+                %s, now() at time zone 'UTC'
+            FROM unnest(%s::int[], %s::int[]) AS data(id, settlement)
+        """, (self.env.uid, self.env.uid, ids, settlement_ids))
+        cr.execute("""
+            INSERT INTO settlement_agent_line_rel
+                (settlement_id, agent_line_id)
+            SELECT data.id, data.agent_line
+            FROM unnest(%s::int[], %s::int[]) AS data(id, agent_line)
+        """, (ids, agent_line_ids))
+        cr.execute("""
+            UPDATE sale_commission_settlement_line scl
+            SET date = aila.invoice_date,
+                invoice_line = aila.object_id,
+                invoice = ail.invoice_id,
+                origin = ail.origin,
+                customer = rp.name,
+                agent = aila.agent,
+                settled_amount = aila.amount,
+                currency_id = ail.currency_id,
+                comm_total = ai.commission_total
+            FROM settlement_agent_line_rel rel
+            JOIN account_invoice_line_agent aila
+                ON aila.id = rel.agent_line_id
+            JOIN account_invoice_line ail ON ail.id = aila.object_id
+            JOIN account_invoice ai ON ai.id = ail.invoice_id
+            LEFT JOIN res_partner rp ON rp.id = ail.partner_id
+            WHERE rel.settlement_id = scl.id AND scl.id = ANY(%s)
+        """, (ids, ))
+        lines = self.browse(ids)
+        settlements = self.env['sale.commission.settlement'].browse(
+            set(settlement_ids))
+        agent_lines = self.env['account.invoice.line.agent'].browse(
+            agent_line_ids)
+        settlements.invalidate_cache(['lines'], settlements.ids)
+        agent_lines.invalidate_cache(['agent_line'], agent_lines.ids)
+        agent_lines._update_settled()
+        # Trigger the computed fields that depend on the new lines
+        settlements.modified(['lines'])
+        if self.env.recompute and self.env.context.get('recompute', True):
+            self.recompute()
+        return lines
+
 
 
 
@@ -0,0 +1,304 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import logging
+import threading
+import time
+from datetime import timedelta
+
+import psycopg2
+
+from odoo import _, api, fields, models
+
+from .settlement_period import PERIOD_MONTHS
+
+_logger = logging.getLogger(__name__)
+
+
+class SettlementJob(models.Model):
+    _name = "sale.commission.settlement.job"
+    _description = "Commission settlement job"
+    _order = "id desc"
+
+    name = fields.Char(readonly=True, default="/", copy=False)
+    date_to = fields.Date(
+        string="Up to", required=True, default=fields.Date.context_today,
+        readonly=True, states={'draft': [('readonly', False)]},
+    )
+    agents = fields.Many2many(
+        comodel_name="res.partner",
+        relation="sale_commission_settlement_job_agent_rel",
+        column1="job_id",
+        column2="agent_id",
+        domain="[('agent', '=', True)]",
+        readonly=True,
+        states={'draft': [('readonly', False)]},
+        help="Keep empty for settling all agents.",
+    )
+    chunk_size = fields.Integer(
+        default=20,
+        help="Number of agent/company pairs settled and committed at once.",
+    )
+    state = fields.Selection(
+        selection=[("draft", "Draft"),
+                   ("running", "Running"),
+                   ("done", "Done"),
+                   ("failed", "With errors")],
+        default="draft", readonly=True, copy=False,
+    )
+    lines = fields.One2many(
+        comodel_name="sale.commission.settlement.job.line",
+        inverse_name="job_id", readonly=True, copy=False,
+    )
+    settlements = fields.Many2many(
+        comodel_name="sale.commission.settlement",
+        compute="_compute_settlements",
+    )
+    settlement_count = fields.Integer(compute="_compute_settlements")
+    cron_id = fields.Many2one(
+        comodel_name="ir.cron", string="Scheduled action", readonly=True,
+        copy=False, ondelete="set null",
+        help="One-time scheduled action running this job apart from the "
+             "rest, so several jobs are run in parallel.",
+    )
+
+    @api.depends('lines.settlements')
+    def _compute_settlements(self):
+        for job in self:
+            job.settlements = job.mapped('lines.settlements')
+            job.settlement_count = len(job.settlements)
+
+    @api.model
+    def create(self, vals):
+        if vals.get('name', '/') == '/':
+            vals['name'] = self.env['ir.sequence'].next_by_code(
+                'sale.commission.settlement.job') or '/'
+        return super().create(vals)
+
+    def _prepare_lines(self):
+        """Create one pending line per agent and company with lines to
+        settle, computed with a single grouped query.
+        """
+        self.ensure_one()
+        wizard = self.env['sale.commission.make.settle']
+        agents = self.agents or self.env['res.partner'].search(
+            [('agent', '=', True)])
+        groups = self.env['account.invoice.line.agent'].read_group(
+            wizard._get_agent_lines_domain(agents, self.date_to),
+            ['agent', 'company_id'], ['agent', 'company_id'], lazy=False,
+        )
+        self.lines = [(0, 0, {
+            'agent_id': group['agent'][0],
+            'company_id': group['company_id'][0],
+        }) for group in groups if group['company_id']]
+
+    def _commit(self):
+        if not getattr(threading.currentThread(), 'testing', False):
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _lock(self):
+        """Lock the job for avoiding several runs of it at the same time.
+
+        :return: False if it's already being processed by other transaction.
+        """
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute(
+                    "SELECT id FROM sale_commission_settlement_job "
+                    "WHERE id = %s FOR UPDATE NOWAIT", (self.id, ),
+                    log_exceptions=False,
+                )
+        except psycopg2.OperationalError:
+            return False
+        return True
+
+    def _run_chunk(self, lines):
+        """Settle the agent/company pairs of the given job lines."""
+        wizard = self.env['sale.commission.make.settle']
+        pairs = {(x.agent_id.id, x.company_id.id) for x in lines}
+        agent_lines = wizard._get_agent_lines(
+            lines.mapped('agent_id'), self.date_to,
+        ).filtered(lambda x: (x.agent.id, x.company_id.id) in pairs)
+        settlements = wizard._settle_agent_lines(agent_lines)
+        for line in lines:
+            line.write({
+                'state': 'done',
+                'settlements': [(6, 0, settlements.filtered(
+                    lambda x: (x.agent == line.agent_id and
+                               x.company_id == line.company_id)
+                ).ids)],
+            })
+
+    def _run(self):
+        """Process the pending lines of the job in chunks, committing after
+        each one, so the job can be resumed from the last finished chunk.
+        """
+        self.ensure_one()
+        if not self._lock():
+            _logger.info("Settlement job %s is already running", self.name)
+            return
+        if self.state == 'draft':
+            self._prepare_lines()
+            self.state = 'running'
+            self._commit()
+        while True:
+            # The lock is released on each commit, so it's taken again before
+            # reading the pending lines, which other workers may have done
+            if not self._lock():
+                return
+            self.invalidate_cache(['lines'], self.ids)
+            self.env['sale.commission.settlement.job.line'].invalidate_cache(
+                ['state'])
+            chunk = self.lines.filtered(
+                lambda x: x.state == 'pending')[:max(self.chunk_size, 1)]
+            if not chunk:
+                break
+            start = time.time()
+            try:
+                with self.env.cr.savepoint():
+                    self._run_chunk(chunk)
+            except Exception as e:
+                _logger.exception("Error in settlement job %s", self.name)
+                self.invalidate_cache()
+                chunk.write({
+                    'state': 'failed',
+                    'error': getattr(e, 'name', False) or str(e),
+                })
+            chunk.write({'duration': time.time() - start})
+            _logger.info(
+                "Settlement job %s: %d/%d agents processed", self.name,
+                len(self.lines.filtered(lambda x: x.state != 'pending')),
+                len(self.lines),
+            )
+            self._commit()
+        self.state = (
+            'failed' if 'failed' in self.lines.mapped('state') else 'done')
+        self._commit()
+
+    @api.multi
+    def action_run(self):
+        for job in self:
+            job._run()
+
+    @api.multi
+    def action_retry(self):
+        """Put failed lines again as pending, for being processed on next
+        run.
+        """
+        self.mapped('lines').filtered(lambda x: x.state == 'failed').write({
+            'state': 'pending',
+            'error': False,
+        })
+        self.filtered(lambda x: x.state == 'failed').write({
+            'state': 'running',
+        })
+
+    @api.multi
+    def action_view_settlements(self):
+        self.ensure_one()
+        return {
+            'name': _('Settlements'),
+            'type': 'ir.actions.act_window',
+            'views': [[False, 'list'], [False, 'form']],
+            'res_model': 'sale.commission.settlement',
+            'domain': [['id', 'in', self.settlements.ids]],
+        }
+
+    @api.multi
+    def _schedule(self):
+        """Create a one-time scheduled action for each job. Each scheduled
+        action is taken by a different worker of scheduled actions, so the
+        jobs are run in parallel instead of one after the other by the
+        periodic one.
+        """
+        model = self.env['ir.model']._get(self._name)
+        for job in self:
+            job.cron_id = self.env['ir.cron'].sudo().create({
+                'name': _("Commissions: run settlement job %s") % job.name,
+                'model_id': model.id,
+                'state': 'code',
+                'code': 'model.browse(%d)._run()' % job.id,
+                'user_id': self.env.uid,
+                'interval_number': 1,
+                'interval_type': 'minutes',
+                'numbercall': 1,
+                'nextcall': fields.Datetime.now(),
+                'doall': False,
+            })
+
+    @api.model
+    def _clean_crons(self):
+        """Remove the one-time scheduled actions already run."""
+        crons = self.search([
+            ('state', 'in', ('done', 'failed')),
+            ('cron_id', '!=', False),
+        ]).mapped('cron_id').sudo().filtered(lambda x: not x.active)
+        actions = crons.mapped('ir_actions_server_id')
+        crons.unlink()
+        actions.unlink()
+        self.invalidate_cache(['cron_id'])
+
+    @api.model
+    def _cron_settle_closed_periods(self, days=1, date=None):
+        """Settle the agents whose settlement period has been closed in the
+        last `days` days.
+
+        :param date: Reference date. Today if not provided.
+        """
+        calendar = self.env['sale.commission.period']
+        date = date or fields.Date.context_today(self)
+        previous_date = date - timedelta(days=days)
+        settlement_types = [
+            x for x in PERIOD_MONTHS
+            if (calendar._get_period_start(x, date) >
+                calendar._get_period_start(x, previous_date))
+        ]
+        agents = self.env['res.partner'].search([
+            ('agent', '=', True),
+            ('settlement', 'in', settlement_types),
+        ])
+        if not agents:
+            return self
+        job = self.create({
+            'date_to': date,
+            'agents': [(6, 0, agents.ids)],
+        })
+        job._run()
+        return job
+
+    @api.model
+    def _cron_run(self):
+        """Resume or start the pending settlement jobs, skipping the ones
+        being run by other workers.
+        """
+        self._clean_crons()
+        for job in self.search([('state', 'in', ('draft', 'running'))]):
+            job._run()
+
+
+class SettlementJobLine(models.Model):
+    _name = "sale.commission.settlement.job.line"
+    _description = "Progress of a commission settlement job"
+
+    job_id = fields.Many2one(
+        comodel_name="sale.commission.settlement.job",
+        required=True, ondelete="cascade",
+    )
+    agent_id = fields.Many2one(
+        comodel_name="res.partner", string="Agent", required=True,
+    )
+    company_id = fields.Many2one(comodel_name="res.company", required=True)
+    state = fields.Selection(
+        selection=[("pending", "Pending"),
+                   ("done", "Done"),
+                   ("failed", "Failed")],
+        default="pending", required=True,
+    )
+    settlements = fields.Many2many(
+        comodel_name="sale.commission.settlement",
+        relation="sale_commission_settlement_job_line_settlement_rel",
+        column1="job_line_id",
+        column2="settlement_id",
+    )
+    duration = fields.Float(
+        help="Seconds spent in the chunk where this line was processed.")
+    error = fields.Text()
@@ -0,0 +1,73 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from bisect import bisect_right
+from datetime import timedelta
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import _, api, exceptions, fields, models
+
+# Length in months of each value of the `settlement` field of partners
+PERIOD_MONTHS = {
+    'monthly': 1,
+    'quaterly': 3,
+    'semi': 6,
+    'annual': 12,
+}
+
+
+class SaleCommissionPeriod(models.AbstractModel):
+    _name = "sale.commission.period"
+    _description = "Calendar of commission settlement periods"
+
+    @api.model
+    def _get_period_months(self, settlement):
+        """Get the length in months of the given settlement period type."""
+        months = PERIOD_MONTHS.get(settlement)
+        if not months:
+            raise exceptions.Warning(_("Settlement period not valid."))
+        return months
+
+    @api.model
+    def _get_period_start(self, settlement, day):
+        """Get the first day of the period of type `settlement` which
+        contains `day`.
+        """
+        if isinstance(day, str):
+            day = fields.Date.from_string(day)
+        months = self._get_period_months(settlement)
+        return day.replace(month=(day.month - 1) // months * months + 1, day=1)
+
+    @api.model
+    def _get_period_boundaries(self, settlement, date_from, date_to):
+        """Get the sorted start dates of all the periods of type
+        `settlement` between both dates, followed by the start date of the
+        next period, so each consecutive pair delimits one period.
+        """
+        step = relativedelta(months=self._get_period_months(settlement))
+        boundaries = [self._get_period_start(settlement, date_from)]
+        while boundaries[-1] <= date_to:
+            boundaries.append(boundaries[-1] + step)
+        return boundaries
+
+    @api.model
+    def _map_dates_to_periods(self, settlement, dates):
+        """Map a list of dates to their periods in one pass.
+
+        The period boundaries are computed once for the whole range of
+        dates, and each date is then located with a binary search.
+
+        :param settlement: Settlement period type, as in partner's field.
+        :param dates: List of dates.
+        :return: Tuple with the list of period indexes (one per date) and
+          the list of periods as (date from, date to) tuples.
+        """
+        if not dates:
+            return [], []
+        boundaries = self._get_period_boundaries(
+            settlement, min(dates), max(dates))
+        periods = [
+            (boundaries[i], boundaries[i + 1] - timedelta(days=1))
+            for i in range(len(boundaries) - 1)
+        ]
+        return [bisect_right(boundaries, x) - 1 for x in dates], periods
@@ -1,6 +1,9 @@
 # Copyright 2016-2019 Tecnativa - Pedro M. Baeza
 # License AGPL-3 - See https://www.gnu.org/licenses/agpl-3.0.html
 
+from odoo.addons.sale_commission.models.sale_commission_mixin import (
+    PARTNER_AGENTS_MEMO,
+)
 from odoo.addons.sale_commission.models.settlement import Settlement
 from odoo import fields
 from odoo.tests.common import SavepointCase
@@ -672,3 +675,783 @@ class TestSaleCommission(SavepointCase):
             'name': 'Test child',
         })
         self.assertEqual(child.agents, partner.agents)
+
+    def test_res_partner_agent_propagation_set(self):
+        partners = self.env['res.partner'].create([{
+            'name': 'Test partner %s' % i,
+            'agents': [(4, self.agent_monthly.id)],
+        } for i in range(2)])
+        children = self.env['res.partner'].create([{
+            'name': 'Test child %s' % partner.id,
+            'parent_id': partner.id,
+        } for partner in partners])
+        self.assertEqual(children.mapped('agents'), self.agent_monthly)
+        grandchild = self.env['res.partner'].create({
+            'name': 'Test grandchild',
+            'parent_id': children[0].id,
+            'agents': [(5, 0)],
+        })
+        other_child = self.env['res.partner'].create({
+            'name': 'Test other child',
+            'parent_id': partners[0].id,
+            'agents': [(6, 0, self.agent_quaterly.ids)],
+        })
+        company_child = self.env['res.partner'].create({
+            'name': 'Test company child',
+            'parent_id': partners[0].id,
+            'is_company': True,
+        })
+        partners.write({'agents': [(4, self.agent_semi.id)]})
+        agents = self.agent_monthly + self.agent_semi
+        self.assertEqual(children[0].agents, agents)
+        self.assertEqual(children[1].agents, agents)
+        # Contacts without agents get the result of the commands
+        self.assertEqual(grandchild.agents, self.agent_semi)
+        # Contacts with other agents or companies are not changed
+        self.assertEqual(other_child.agents, self.agent_quaterly)
+        self.assertFalse(company_child.agents)
+        partners.write({'agents': [(3, self.agent_monthly.id)]})
+        self.assertEqual(children.mapped('agents'), self.agent_semi)
+        self.assertEqual(other_child.agents, self.agent_quaterly)
+
+    def _invoice_sale_order(self, sale_order, validate=True):
+        sale_order.action_confirm()
+        payment = self.advance_inv_model.create({
+            'advance_payment_method': 'all',
+        })
+        payment.with_context(active_model='sale.order',
+                             active_ids=sale_order.ids,
+                             active_id=sale_order.id).create_invoices()
+        if validate:
+            sale_order.invoice_ids.action_invoice_open()
+        return sale_order.invoice_ids
+
+    def test_settle_several_agents(self):
+        agents = (self.agent_monthly + self.agent_quaterly +
+                  self.agent_semi + self.agent_annual)
+        invoices = self.env['account.invoice']
+        for agent in agents:
+            invoices |= self._invoice_sale_order(
+                self._create_sale_order(agent, self.commission_net_invoice))
+        agent_lines = invoices.mapped('invoice_line_ids.agents')
+        wizard = self.make_settle_model.create({
+            'date_to': (fields.Datetime.from_string(fields.Datetime.now()) +
+                        dateutil.relativedelta.relativedelta(months=12)),
+            'agents': [(6, 0, agents.ids)],
+        })
+        wizard.action_settle()
+        settlements = self.settle_model.search([('agent', 'in', agents.ids)])
+        self.assertEqual(settlements.mapped('agent'), agents)
+        self.assertEqual(len(settlements), len(agents))
+        self.assertTrue(all(agent_lines.mapped('settled')))
+        for settlement in settlements:
+            date_invoice = settlement.lines.date
+            self.assertEqual(settlement.date_from, wizard._get_period_start(
+                settlement.agent, date_invoice))
+            self.assertEqual(
+                settlement.lines.agent_line,
+                agent_lines.filtered(lambda x: x.agent == settlement.agent))
+        # A second run doesn't settle anything more
+        wizard.action_settle()
+        self.assertEqual(
+            self.settle_model.search([('agent', 'in', agents.ids)]),
+            settlements)
+
+    def test_settlement_lines_bulk_creation(self):
+        invoice = self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        agent_line = invoice.mapped('invoice_line_ids.agents')
+        settlement = self.settle_model.create({
+            'agent': self.agent_monthly.id,
+            'date_from': invoice.date_invoice,
+            'date_to': invoice.date_invoice,
+            'company_id': invoice.company_id.id,
+        })
+        line = self.env[
+            'sale.commission.settlement.line'
+        ]._create_from_agent_lines({settlement.id: agent_line.ids})
+        self.assertEqual(settlement.lines, line)
+        self.assertEqual(line.agent_line, agent_line)
+        self.assertEqual(line.date, agent_line.invoice_date)
+        self.assertEqual(line.invoice_line, agent_line.object_id)
+        self.assertEqual(line.invoice, invoice)
+        self.assertEqual(line.origin, agent_line.object_id.origin)
+        self.assertEqual(line.customer, invoice.partner_id.name)
+        self.assertEqual(line.agent, self.agent_monthly)
+        self.assertEqual(line.settled_amount, agent_line.amount)
+        self.assertEqual(line.currency_id, invoice.currency_id)
+        self.assertEqual(line.comm_total, invoice.commission_total)
+        self.assertAlmostEqual(settlement.total, agent_line.amount)
+        self.assertTrue(agent_line.settled)
+        other_company = self.env['res.company'].create({'name': 'Other'})
+        settlement_other = self.settle_model.create({
+            'agent': self.agent_monthly.id,
+            'company_id': other_company.id,
+        })
+        with self.assertRaises(UserError):
+            self.env[
+                'sale.commission.settlement.line'
+            ]._create_from_agent_lines({settlement_other.id: agent_line.ids})
+
+    def test_period_calendar(self):
+        calendar = self.env['sale.commission.period']
+        day = fields.Date.from_string('2020-08-17')
+        for settlement, expected in [
+            ('monthly', '2020-08-01'), ('quaterly', '2020-07-01'),
+            ('semi', '2020-07-01'), ('annual', '2020-01-01'),
+        ]:
+            self.assertEqual(
+                calendar._get_period_start(settlement, day),
+                fields.Date.from_string(expected))
+        dates = [fields.Date.from_string(x) for x in (
+            '2020-01-31', '2020-02-01', '2020-03-31', '2020-04-01',
+        )]
+        buckets, periods = calendar._map_dates_to_periods('quaterly', dates)
+        self.assertEqual(buckets, [0, 0, 0, 1])
+        self.assertEqual(periods[0], (
+            fields.Date.from_string('2020-01-01'),
+            fields.Date.from_string('2020-03-31'),
+        ))
+        with self.assertRaises(UserError):
+            calendar._get_period_months('weekly')
+
+    def test_settle_extended_lines_periods(self):
+        self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        wizard = self.make_settle_model.create({
+            'date_to': (fields.Datetime.from_string(fields.Datetime.now()) +
+                        dateutil.relativedelta.relativedelta(months=3)),
+            'agents': [(6, 0, self.agent_monthly.ids)],
+        })
+
+        def _get_lines_periods(wizard, agent, lines):
+            res = []
+            for line in lines:
+                date_from = line.invoice_date.replace(day=1)
+                res.append((date_from, date_from + (
+                    dateutil.relativedelta.relativedelta(months=2, days=-1)
+                )))
+            return res
+
+        with patch.object(type(wizard), '_get_lines_periods',
+                          _get_lines_periods):
+            wizard.action_settle()
+        settlement = self.settle_model.search(
+            [('agent', '=', self.agent_monthly.id)])
+        self.assertEqual(
+            settlement.date_to,
+            settlement.date_from + dateutil.relativedelta.relativedelta(
+                months=2, days=-1))
+
+    def test_settle_reuses_open_settlement(self):
+        date_to = (fields.Datetime.from_string(fields.Datetime.now()) +
+                   dateutil.relativedelta.relativedelta(months=1))
+        self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        wizard = self.make_settle_model.create({
+            'date_to': date_to,
+            'agents': [(6, 0, self.agent_monthly.ids)],
+        })
+        wizard.action_settle()
+        settlement = self.settle_model.search(
+            [('agent', '=', self.agent_monthly.id)])
+        self.assertEqual(len(settlement.lines), 1)
+        cache = wizard._get_settlements_cache([(
+            settlement.agent, settlement.company_id,
+            settlement.date_from, settlement.date_to,
+        )])
+        self.assertEqual(list(cache.values()), [settlement])
+        self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        wizard.action_settle()
+        self.assertEqual(
+            self.settle_model.search([('agent', '=', self.agent_monthly.id)]),
+            settlement)
+        self.assertEqual(len(settlement.lines), 2)
+        # Settlements of other periods of the agent are not reused
+        settlement.date_to = settlement.date_to.replace(day=1)
+        self.assertFalse(wizard._get_settlements_cache([(
+            settlement.agent, settlement.company_id,
+            settlement.date_from, settlement.date_to.replace(day=2),
+        )]))
+
+    def test_settleable_lines_batch(self):
+        invoice_paid_comm = self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_paid))
+        invoice_open_comm = self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        invoice_draft = self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice), validate=False)
+        invoices = invoice_paid_comm + invoice_open_comm + invoice_draft
+        agent_lines = invoices.mapped('invoice_line_ids.agents')
+        self.assertTrue(
+            invoice_draft.invoice_line_ids.agents[0]._skip_settlement())
+        self.assertEqual(
+            agent_lines._get_settleable_ids(),
+            set(invoice_open_comm.mapped('invoice_line_ids.agents').ids))
+        journal = self.env['account.journal'].search([
+            ('type', '=', 'cash'),
+            ('company_id', '=', invoice_paid_comm.company_id.id),
+        ], limit=1)
+        invoice_paid_comm.pay_and_reconcile(
+            journal, invoice_paid_comm.amount_total)
+        agent_lines.invalidate_cache()
+        self.assertEqual(
+            agent_lines._get_settleable_ids(),
+            set((invoice_paid_comm + invoice_open_comm).mapped(
+                'invoice_line_ids.agents').ids))
+
+    def test_settle_parallel_shards(self):
+        agents = self.agent_monthly + self.agent_quaterly
+        for agent in agents:
+            self._invoice_sale_order(self._create_sale_order(
+                agent, self.commission_net_invoice))
+        wizard = self.make_settle_model.create({
+            'date_to': (fields.Datetime.from_string(fields.Datetime.now()) +
+                        dateutil.relativedelta.relativedelta(months=3)),
+            'agents': [(6, 0, agents.ids)],
+            'workers': 2,
+        })
+        action = wizard.action_settle()
+        jobs = self.env[action['res_model']].search(action['domain'])
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(jobs.mapped('agents'), agents)
+        for job in jobs:
+            self.assertEqual(len(job.agents), 1)
+            self.assertEqual(job.cron_id.numbercall, 1)
+            self.assertIn('%d' % job.id, job.cron_id.code)
+        get_agent_lines = type(wizard)._get_agent_lines
+        failing_agent = self.agent_quaterly
+
+        def failing_get_agent_lines(self, agents, date_to):
+            if failing_agent in agents:
+                raise UserError("Shard failure")
+            return get_agent_lines(self, agents, date_to)
+
+        with patch.object(
+            type(wizard), '_get_agent_lines', failing_get_agent_lines,
+        ):
+            jobs.mapped('cron_id').method_direct_trigger()
+        failed_job = jobs.filtered(lambda x: x.agents == failing_agent)
+        self.assertEqual(failed_job.state, 'failed')
+        self.assertIn("Shard failure", failed_job.lines.error)
+        self.assertEqual((jobs - failed_job).state, 'done')
+        settlements = self.settle_model.search([('agent', 'in', agents.ids)])
+        self.assertEqual(settlements.mapped('agent'), self.agent_monthly)
+        # Run scheduled actions are removed
+        jobs.mapped('cron_id').write({'active': False})
+        self.env['sale.commission.settlement.job']._cron_run()
+        self.assertFalse(jobs.mapped('cron_id'))
+
+    def test_settlement_job(self):
+        agents = self.agent_monthly + self.agent_quaterly
+        for agent in agents:
+            self._invoice_sale_order(self._create_sale_order(
+                agent, self.commission_net_invoice))
+        wizard = self.make_settle_model.create({
+            'date_to': (fields.Datetime.from_string(fields.Datetime.now()) +
+                        dateutil.relativedelta.relativedelta(months=3)),
+            'agents': [(6, 0, agents.ids)],
+        })
+        job = self.env['sale.commission.settlement.job'].browse(
+            wizard.action_create_job()['res_id'])
+        self.assertEqual(job.agents, agents)
+        job.chunk_size = 1
+        settle_agent_lines = type(wizard)._settle_agent_lines
+        failing_agent = self.agent_quaterly
+
+        def failing_settle_agent_lines(self, agent_lines, *args, **kwargs):
+            if failing_agent in agent_lines.mapped('agent'):
+                raise UserError("Chunk failure")
+            return settle_agent_lines(self, agent_lines, *args, **kwargs)
+
+        with patch.object(
+            type(wizard), '_settle_agent_lines', failing_settle_agent_lines,
+        ):
+            job.action_run()
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(len(job.lines), 2)
+        failed = job.lines.filtered(lambda x: x.state == 'failed')
+        self.assertEqual(failed.agent_id, self.agent_quaterly)
+        self.assertIn("Chunk failure", failed.error)
+        self.assertEqual(job.settlements.agent, self.agent_monthly)
+        job.action_retry()
+        self.assertEqual(failed.state, 'pending')
+        self.env['sale.commission.settlement.job']._cron_run()
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.settlements.mapped('agent'), agents)
+
+    def test_cron_settle_closed_periods(self):
+        today = fields.Date.from_string(fields.Date.today())
+        # Monthly and quarterly periods close that day, but not the others
+        date = today.replace(month=4, day=1)
+        agents = self.agent_monthly + self.agent_quaterly + self.agent_semi
+        for agent in agents:
+            invoice = self._invoice_sale_order(self._create_sale_order(
+                agent, self.commission_net_invoice), validate=False)
+            invoice.date_invoice = date.replace(year=date.year - 1)
+            invoice.action_invoice_open()
+        job = self.env[
+            'sale.commission.settlement.job'
+        ]._cron_settle_closed_periods(date=date)
+        self.assertIn(self.agent_monthly, job.agents)
+        self.assertIn(self.agent_quaterly, job.agents)
+        self.assertNotIn(self.agent_semi, job.agents)
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(
+            self.settle_model.search([('agent', 'in', agents.ids)]).mapped(
+                'agent'),
+            self.agent_monthly + self.agent_quaterly)
+
+    def test_settled_follows_settlement_state(self):
+        invoice = self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        agent_line = invoice.mapped('invoice_line_ids.agents')
+        self.make_settle_model.create({
+            'date_to': (fields.Datetime.from_string(fields.Datetime.now()) +
+                        dateutil.relativedelta.relativedelta(months=1)),
+            'agents': [(6, 0, self.agent_monthly.ids)],
+        }).action_settle()
+        settlement = agent_line.agent_line.settlement
+        self.assertTrue(agent_line.settled)
+        self.assertTrue(agent_line.object_id.any_settled)
+        settlement.action_cancel()
+        self.assertFalse(agent_line.settled)
+        self.assertFalse(agent_line.object_id.any_settled)
+        settlement.write({'state': 'settled'})
+        self.assertTrue(agent_line.settled)
+        settlement.write({'state': 'cancel'})
+        settlement.unlink()
+        self.assertFalse(agent_line.settled)
+        self.assertFalse(agent_line.agent_line)
+
+    def _settle_two_periods(self, agent):
+        """Create two settlements of the given monthly agent in consecutive
+        periods, returning them.
+        """
+        date = fields.Date.from_string(fields.Date.today()).replace(day=1)
+        for months in (2, 1):
+            invoice = self._invoice_sale_order(self._create_sale_order(
+                agent, self.commission_net_invoice), validate=False)
+            invoice.date_invoice = (
+                date - dateutil.relativedelta.relativedelta(months=months))
+            invoice.action_invoice_open()
+        self.make_settle_model.create({
+            'date_to': date,
+            'agents': [(6, 0, agent.ids)],
+        }).action_settle()
+        settlements = self.settle_model.search([('agent', '=', agent.id)])
+        self.assertEqual(len(settlements), 2)
+        return settlements
+
+    def test_make_invoices_bulk(self):
+        settlements = self._settle_two_periods(self.agent_monthly)
+        cache = {}
+        settlements.make_invoices(self.journal, self.product, cache=cache)
+        # Same header and line values for both settlements
+        self.assertEqual(
+            len([x for x in cache if x[0] == 'account.invoice']), 1)
+        self.assertEqual(
+            len([x for x in cache if x[0] == 'account.invoice.line']), 1)
+        invoices = settlements.mapped('invoice')
+        self.assertEqual(len(invoices), 2)
+        for settlement in settlements:
+            self.assertEqual(settlement.state, 'invoiced')
+            line = settlement.invoice.invoice_line_ids
+            self.assertEqual(len(line), 1)
+            self.assertAlmostEqual(line.price_unit, settlement.total)
+            self.assertIn("Period", line.name)
+
+    def test_make_invoices_grouped(self):
+        settlements = self._settle_two_periods(self.agent_monthly)
+        self.make_inv_model.with_context(
+            settlement_ids=settlements.ids,
+        ).create({
+            'journal': self.journal.id,
+            'product': self.product.id,
+            'grouped': True,
+        }).button_create()
+        invoice = settlements.mapped('invoice')
+        self.assertEqual(len(invoice), 1)
+        self.assertEqual(invoice.partner_id, self.agent_monthly)
+        self.assertEqual(len(invoice.invoice_line_ids), 2)
+        self.assertAlmostEqual(
+            invoice.amount_untaxed, sum(settlements.mapped('total')))
+        self.assertEqual(set(settlements.mapped('state')), {'invoiced'})
+
+    def test_commission_amounts_batch(self):
+        invoice = self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        agent_line = invoice.mapped('invoice_line_ids.agents')
+        inv_line = agent_line.object_id
+        free_product = self.product.copy({'commission_free': True})
+        commissions = (
+            self.commission_net_paid + self.commission_net_invoice +
+            self.commission_section_paid + self.commission_section_invoice +
+            self.env.ref('sale_commission.demo_commission')
+        )
+        values = []
+        for commission in commissions:
+            for subtotal in (0.0, 50.0, 15500.0, inv_line.price_subtotal):
+                for product in (inv_line.product_id, free_product):
+                    values.append((commission, subtotal, product, 2.0))
+        values.append((self.env['sale.commission'], 100.0, self.product, 1))
+        lines = agent_line.browse([agent_line.id] * len(values))
+        amounts = lines._get_commission_amounts(values)
+        for vals, amount in zip(values, amounts):
+            self.assertAlmostEqual(
+                amount, agent_line._get_commission_amount(*vals))
+
+    def test_sale_order_commission_amounts_batch(self):
+        commission = self.commission_net_invoice
+        self.product.standard_price = 10.0
+        sale_order = self._create_sale_order(self.agent_monthly, commission)
+        sale_order.order_line = [(0, 0, {
+            'name': self.product.name,
+            'product_id': self.product.id,
+            'product_uom_qty': qty,
+            'product_uom': self.ref('uom.product_uom_unit'),
+            'price_unit': 100.0,
+            'agents': [(0, 0, {
+                'agent': self.agent_monthly.id,
+                'commission': commission.id,
+            })],
+        }) for qty in (1.0, 2.0, 3.0)]
+        sale_order.order_line.write({'discount': 10.0})
+        for line in sale_order.order_line:
+            self.assertAlmostEqual(
+                line.agents.amount, line.agents._get_commission_amount(
+                    commission, line.price_subtotal, line.product_id,
+                    line.product_uom_qty))
+
+    def test_calculate_sections(self):
+        commission = self.commission_model.create({
+            'name': 'Tiered commission',
+            'commission_type': 'section',
+            'sections': [
+                (0, 0, {'amount_from': 1000.01, 'amount_to': 5000.0,
+                        'percent': 10.0}),
+                (0, 0, {'amount_from': 0.0, 'amount_to': 1000.0,
+                        'percent': 5.0}),
+                (0, 0, {'amount_from': 6000.0, 'amount_to': 10000.0,
+                        'percent': 20.0}),
+            ],
+        })
+        bases = [-1.0, 0.0, 500.0, 1000.0, 1000.005, 3000.0, 5000.0, 5500.0,
+                 6000.0, 10000.0, 10000.5]
+        expected = [0.0, 0.0, 25.0, 50.0, 0.0, 300.0, 500.0, 0.0, 1200.0,
+                    2000.0, 0.0]
+        for base, amount in zip(bases, commission.calculate_sections(bases)):
+            self.assertAlmostEqual(commission.calculate_section(base), amount)
+        self.assertEqual(
+            [round(x, 2) for x in commission.calculate_sections(bases)],
+            expected)
+        # Cache is invalidated on section change
+        commission.sections.filtered(
+            lambda x: x.percent == 5.0).percent = 1.0
+        self.assertAlmostEqual(commission.calculate_section(500.0), 5.0)
+        # Overlapping sections: first one wins as before
+        commission.sections = [(0, 0, {
+            'amount_from': 0.0, 'amount_to': 20000.0, 'percent': 50.0,
+        })]
+        self.assertAlmostEqual(commission.calculate_section(500.0), 5.0)
+        self.assertAlmostEqual(
+            commission.calculate_section(15000.0), 7500.0)
+
+    def test_compiled_commission(self):
+        commission = self.commission_model.create({
+            'name': 'Compiled commission',
+            'fix_qty': 10.0,
+        })
+        rule = commission._get_compiled()
+        self.assertEqual(rule.commission_type, 'fixed')
+        self.assertAlmostEqual(rule.fix_rate, 0.1)
+        self.assertIs(commission._get_compiled(), rule)
+        # Changes inside the same transaction are taken into account
+        commission.write({
+            'commission_type': 'section',
+            'amount_base_type': 'net_amount',
+            'sections': [(0, 0, {
+                'amount_from': 0.0, 'amount_to': 100.0, 'percent': 5.0,
+            })],
+        })
+        rule = commission._get_compiled()
+        self.assertEqual(rule.commission_type, 'section')
+        self.assertEqual(rule.amount_base_type, 'net_amount')
+        self.assertEqual(rule.percents, (5.0, ))
+        commission.sections.amount_to = 50.0
+        self.assertEqual(commission._get_compiled().ends, (50.0, ))
+
+    def test_progressive_sections(self):
+        commission = self.commission_model.create({
+            'name': 'Progressive commission',
+            'commission_type': 'progressive',
+            'sections': [
+                (0, 0, {'amount_from': 1000.0, 'amount_to': 5000.0,
+                        'percent': 10.0}),
+                (0, 0, {'amount_from': 0.0, 'amount_to': 1000.0,
+                        'percent': 5.0}),
+                (0, 0, {'amount_from': 6000.0, 'amount_to': 10000.0,
+                        'percent': 20.0}),
+            ],
+        })
+        bases = [-1.0, 0.0, 500.0, 1000.0, 3000.0, 5500.0, 7000.0, 20000.0]
+        expected = [0.0, 0.0, 25.0, 50.0, 250.0, 450.0, 650.0, 1250.0]
+        self.assertEqual(
+            [round(x, 2) for x in
+             commission.calculate_progressive_sections(bases)],
+            expected)
+        # Unsorted sections sharing their limits
+        commission_touching = self.commission_model.create({
+            'name': 'Progressive commission with touching sections',
+            'commission_type': 'progressive',
+            'sections': [
+                (0, 0, {'amount_from': 5000.0, 'amount_to': 10000.0,
+                        'percent': 20.0}),
+                (0, 0, {'amount_from': 1000.0, 'amount_to': 5000.0,
+                        'percent': 10.0}),
+                (0, 0, {'amount_from': 0.0, 'amount_to': 1000.0,
+                        'percent': 5.0}),
+            ],
+        })
+        rule = commission_touching._get_compiled()
+        self.assertFalse(rule.overlapped)
+        self.assertEqual(rule.starts, (0.0, 1000.0, 5000.0))
+        self.assertEqual(
+            [round(x, 2) for x in
+             commission_touching.calculate_progressive_sections(
+                 [999.0, 1000.0, 1001.0, 5000.0, 8000.0])],
+            [49.95, 50.0, 50.1, 450.0, 1050.0])
+        agent_line = self.env['sale.order.line.agent'].new({
+            'agent': self.agent_monthly.id,
+            'commission': commission.id,
+        })
+        self.assertAlmostEqual(agent_line._get_commission_amount(
+            commission, 3000.0, self.product, 1.0), 250.0)
+        with self.assertRaises(ValidationError):
+            commission.sections = [(0, 0, {
+                'amount_from': 4000.0, 'amount_to': 5500.0, 'percent': 1.0,
+            })]
+
+    def test_volume_commission(self):
+        price = self.product.lst_price
+        commission = self.commission_model.create({
+            'name': 'Volume commission',
+            'commission_type': 'volume',
+            'sections': [
+                (0, 0, {'amount_from': 0.0, 'amount_to': price * 1.5,
+                        'percent': 5.0}),
+                (0, 0, {'amount_from': price * 1.5 + 0.01,
+                        'amount_to': price * 100, 'percent': 10.0}),
+            ],
+        })
+        invoice1 = self._invoice_sale_order(
+            self._create_sale_order(self.agent_monthly, commission))
+        agent_line1 = invoice1.mapped('invoice_line_ids.agents')
+        volume = agent_line1.volume_id
+        self.assertEqual(volume.agent_id, self.agent_monthly)
+        self.assertAlmostEqual(volume.amount, price)
+        self.assertAlmostEqual(agent_line1.volume_amount, price)
+        self.assertAlmostEqual(agent_line1.amount, price * 0.05)
+        invoice2 = self._invoice_sale_order(
+            self._create_sale_order(self.agent_monthly, commission))
+        agent_line2 = invoice2.mapped('invoice_line_ids.agents')
+        self.assertEqual(agent_line2.volume_id, volume)
+        self.assertAlmostEqual(volume.amount, price * 2)
+        self.assertAlmostEqual(agent_line2.amount, price * 0.1)
+        # Previous lines are not recomputed
+        self.assertAlmostEqual(agent_line1.amount, price * 0.05)
+        # Draft invoices are estimated, but not added to the volume
+        invoice3 = self._invoice_sale_order(
+            self._create_sale_order(self.agent_monthly, commission),
+            validate=False)
+        agent_line3 = invoice3.mapped('invoice_line_ids.agents')
+        self.assertFalse(agent_line3.volume_id)
+        self.assertAlmostEqual(agent_line3.amount, price * 0.1)
+        self.assertAlmostEqual(volume.amount, price * 2)
+        # Removed lines are subtracted from the volume
+        agent_line2.unlink()
+        self.assertAlmostEqual(volume.amount, price)
+        # Lines of other commissions are not registered
+        invoice4 = self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        agent_line4 = invoice4.mapped('invoice_line_ids.agents')
+        self.assertFalse(agent_line4.volume_id)
+        self.assertAlmostEqual(volume.amount, price)
+        # Lines moved to other commission are removed from the volume
+        agent_line1.commission = self.commission_net_invoice
+        self.assertFalse(agent_line1.volume_id)
+        self.assertAlmostEqual(volume.amount, 0.0)
+
+    def test_volume_commission_settlement_change(self):
+        price = self.product.lst_price
+        commission = self.commission_model.create({
+            'name': 'Volume commission',
+            'commission_type': 'volume',
+            'sections': [
+                (0, 0, {'amount_from': 0.0, 'amount_to': price * 100,
+                        'percent': 5.0}),
+            ],
+        })
+        date = fields.Date.context_today(self.commission_model).replace(
+            month=1, day=1)
+        volumes = []
+        # Periods starting on the same date are kept apart
+        for settlement in ('monthly', 'annual'):
+            self.agent_monthly.settlement = settlement
+            invoice = self._invoice_sale_order(
+                self._create_sale_order(self.agent_monthly, commission),
+                validate=False)
+            invoice.date_invoice = date
+            invoice.action_invoice_open()
+            volumes.append(
+                invoice.mapped('invoice_line_ids.agents.volume_id'))
+        self.assertNotEqual(volumes[0], volumes[1])
+        self.assertEqual(volumes[0].date_from, volumes[1].date_from)
+        self.assertEqual(volumes[1].date_to, date.replace(month=12, day=31))
+        self.assertAlmostEqual(volumes[0].amount, price)
+        self.assertAlmostEqual(volumes[1].amount, price)
+
+    def test_create_lines_agents_once_per_parent(self):
+        self.partner.agents = self.agent_monthly
+        orders = self.sale_order_model.create([
+            {'partner_id': self.partner.id},
+            {'partner_id': self.partner.id},
+        ])
+        sale_line_model = self.env['sale.order.line']
+        original = type(sale_line_model)._prepare_agents_vals
+        calls = []
+
+        def _prepare_agents_vals(line, vals=None):
+            calls.append(vals['order_id'])
+            return original(line, vals=vals)
+
+        with patch.object(type(sale_line_model), '_prepare_agents_vals',
+                          _prepare_agents_vals):
+            lines = sale_line_model.create([{
+                'order_id': order.id,
+                'name': self.product.name,
+                'product_id': self.product.id,
+                'product_uom_qty': 1.0,
+                'product_uom': self.product.uom_id.id,
+                'price_unit': 10.0,
+            } for order in orders for i in range(3)])
+        self.assertEqual(calls, orders.ids)
+        for line in lines:
+            self.assertEqual(line.agents.mapped('agent'), self.agent_monthly)
+        self.assertEqual(len(lines.mapped('agents')), 6)
+        invoice = self._invoice_sale_order(orders[0], validate=False)
+        invoice_line_model = self.env['account.invoice.line']
+        with patch.object(type(invoice_line_model), '_prepare_agents_vals',
+                          autospec=True, return_value=[]) as mocked:
+            invoice_line_model.create([{
+                'invoice_id': invoice.id,
+                'name': 'Test line %s' % i,
+                'account_id': invoice.invoice_line_ids[0].account_id.id,
+                'price_unit': 10.0,
+            } for i in range(3)])
+        self.assertEqual(mocked.call_count, 1)
+
+    def test_partner_agents_memo(self):
+        line_model = self.env['sale.order.line']
+        self.agent_monthly.commission = self.commission_net_invoice
+        self.partner.agents = self.agent_monthly
+        # Changes in partners stop the memo until the transaction ends
+        self.assertIsNone(self.env.cr.cache[PARTNER_AGENTS_MEMO])
+        self.env.cr.cache.pop(PARTNER_AGENTS_MEMO)
+        vals = line_model._prepare_agents_vals_partner(self.partner)
+        self.assertEqual(vals, [(0, 0, {
+            'agent': self.agent_monthly.id,
+            'commission': self.commission_net_invoice.id,
+        })])
+        self.assertTrue(self.env.cr.cache[PARTNER_AGENTS_MEMO])
+        # Returned values can be modified without altering the memo
+        vals[0][2]['commission'] = False
+        self.assertEqual(
+            line_model._prepare_agents_vals_partner(self.partner), [(0, 0, {
+                'agent': self.agent_monthly.id,
+                'commission': self.commission_net_invoice.id,
+            })])
+        # Changes rolled back to a savepoint don't leave stale values
+        with self.assertRaises(UserError):
+            with self.env.cr.savepoint():
+                self.agent_monthly.commission = self.commission_net_paid
+                line_model._prepare_agents_vals_partner(self.partner)
+                raise UserError("Rollback")
+        self.agent_monthly.invalidate_cache()
+        self.assertEqual(
+            line_model._prepare_agents_vals_partner(self.partner)[0][2][
+                'commission'], self.commission_net_invoice.id)
+        self.agent_monthly.commission = self.commission_net_paid
+        self.assertEqual(
+            line_model._prepare_agents_vals_partner(self.partner), [(0, 0, {
+                'agent': self.agent_monthly.id,
+                'commission': self.commission_net_paid.id,
+            })])
+        self.partner.agents = self.agent_quaterly
+        self.assertEqual(
+            line_model._prepare_agents_vals_partner(self.partner)[0][2][
+                'agent'], self.agent_quaterly.id)
+
+    def test_recompute_agents_diff(self):
+        self.agent_monthly.commission = self.commission_net_invoice
+        self.agent_quaterly.commission = self.commission_net_invoice
+        self.partner.agents = self.agent_monthly
+        sale_order = self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice)
+        agent_line = sale_order.order_line.agents
+        stats = sale_order.order_line._recompute_agents()
+        self.assertEqual(stats, {
+            'created': 0, 'updated': 0, 'deleted': 0, 'skipped': 0,
+        })
+        self.assertEqual(sale_order.order_line.agents, agent_line)
+        self.agent_monthly.commission = self.commission_net_paid
+        stats = sale_order.order_line._recompute_agents()
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(sale_order.order_line.agents, agent_line)
+        self.assertEqual(agent_line.commission, self.commission_net_paid)
+        self.partner.agents = self.agent_quaterly
+        sale_order.recompute_lines_agents()
+        self.assertFalse(agent_line.exists())
+        self.assertEqual(
+            sale_order.order_line.agents.agent, self.agent_quaterly)
+        # Settled lines are kept as they are
+        invoice = self._invoice_sale_order(sale_order)
+        self.make_settle_model.create({
+            'date_to': (fields.Datetime.from_string(fields.Datetime.now()) +
+                        dateutil.relativedelta.relativedelta(months=3)),
+            'agents': [(6, 0, self.agent_quaterly.ids)],
+        }).action_settle()
+        self.assertTrue(invoice.invoice_line_ids.any_settled)
+        self.partner.agents = self.agent_monthly
+        stats = invoice.invoice_line_ids._recompute_agents()
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(
+            invoice.invoice_line_ids.agents.agent, self.agent_quaterly)
+
+    def test_recompute_agents_wizard(self):
+        self.partner.agents = self.agent_monthly
+        sale_order = self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice)
+        invoice = self._invoice_sale_order(self._create_sale_order(
+            self.agent_monthly, self.commission_net_invoice))
+        self.partner.agents = self.agent_quaterly
+        wizard = self.env['sale.commission.recompute.agents'].with_context(
+            active_model='res.partner', active_ids=self.partner.ids,
+        ).create({'chunk_size': 1})
+        self.assertEqual(wizard.partners, self.partner)
+        wizard.action_recompute()
+        self.assertEqual(wizard.state, 'done')
+        self.assertEqual(
+            sale_order.order_line.agents.agent, self.agent_quaterly)
+        self.assertEqual(
+            invoice.invoice_line_ids.agents.agent, self.agent_quaterly)
+        self.assertIn('1 created', wizard.report)
+        self.assertIn('1 deleted', wizard.report)
+        self.assertIn('1 of 1 lines processed', wizard.report)
+        # Nothing changes on a second run
+        wizard = self.env['sale.commission.recompute.agents'].create({
+            'partner_domain': "[('id', '=', %d)]" % self.partner.id,
+        })
+        wizard.action_recompute()
+        self.assertNotIn('1 created', wizard.report)
@@ -1,3 +1,4 @@
 
 from . import wizard_invoice
 from . import wizard_settle
+from . import wizard_recompute_agents
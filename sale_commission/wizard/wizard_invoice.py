@@ -41,6 +41,11 @@ class SaleCommissionMakeInvoice(models.TransientModel):
         default=_default_settlements)
     from_settlement = fields.Boolean(default=_default_from_settlement)
     date = fields.Date()
+    grouped = fields.Boolean(
+        string="Group invoices",
+        help="Make one invoice per agent and company, with one line per "
+             "settlement, instead of one invoice per settlement.",
+    )
 
     @api.multi
     def button_create(self):
@@ -52,7 +57,7 @@ class SaleCommissionMakeInvoice(models.TransientModel):
                 ('company_id', '=', self.journal.company_id.id)
             ])
         self.settlements.make_invoices(
-            self.journal, self.product, date=self.date)
+            self.journal, self.product, date=self.date, grouped=self.grouped)
         # go to results
         if len(self.settlements):
             return {
@@ -0,0 +1,134 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import logging
+import threading
+
+from odoo import _, api, fields, models
+from odoo.osv import expression
+from odoo.tools import split_every
+from odoo.tools.safe_eval import safe_eval
+
+_logger = logging.getLogger(__name__)
+
+
+class SaleCommissionRecomputeAgents(models.TransientModel):
+    _name = "sale.commission.recompute.agents"
+    _description = "Wizard for recomputing agents of partners documents"
+
+    @api.model
+    def _default_partners(self):
+        if self.env.context.get('active_model') == 'res.partner':
+            return [(6, 0, self.env.context.get('active_ids', []))]
+        return []
+
+    partners = fields.Many2many(
+        comodel_name="res.partner", default=_default_partners,
+        help="Documents of these partners and their contacts are processed.",
+    )
+    partner_domain = fields.Char(
+        string="Partners filter",
+        help="Documents of the partners matching this filter are also "
+             "processed.",
+    )
+    sale_orders = fields.Boolean(string="Sales orders", default=True)
+    invoices = fields.Boolean(string="Customer invoices", default=True)
+    chunk_size = fields.Integer(
+        default=500,
+        help="Number of lines recomputed and committed at once.")
+    state = fields.Selection(
+        selection=[("draft", "Draft"),
+                   ("running", "Running"),
+                   ("done", "Done")], default="draft",
+    )
+    report = fields.Text(readonly=True)
+
+    def _get_partners(self):
+        domains = []
+        if self.partners:
+            domains.append([('id', 'child_of', self.partners.ids)])
+        if self.partner_domain:
+            domains.append(safe_eval(self.partner_domain))
+        if not domains:
+            return self.env['res.partner']
+        return self.env['res.partner'].search(expression.OR(domains))
+
+    def _get_lines_domains(self):
+        """Get the domain of the lines to recompute by model. Settled lines
+        are skipped later.
+        """
+        partners = self._get_partners()
+        res = {}
+        if self.sale_orders:
+            res['sale.order.line'] = [
+                ('order_id.partner_id', 'in', partners.ids),
+                ('order_id.state', 'not in', ('done', 'cancel')),
+            ]
+        if self.invoices:
+            res['account.invoice.line'] = [
+                ('invoice_id.partner_id', 'in', partners.ids),
+                ('invoice_id.type', 'in', ('out_invoice', 'out_refund')),
+                ('invoice_id.state', '!=', 'cancel'),
+            ]
+        return res
+
+    def _commit(self):
+        if not getattr(threading.currentThread(), 'testing', False):
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+
+    def _get_stats_report(self, model, stats):
+        return _(
+            "%s: %d of %d lines processed, %d skipped. Agent lines: %d "
+            "created, %d updated, %d deleted."
+        ) % (self.env[model]._description, stats['done'], stats['total'],
+             stats['skipped'], stats['created'], stats['updated'],
+             stats['deleted'])
+
+    def _recompute_lines(self, model, domain, report):
+        """Recompute the agents of the lines in chunks, committing after
+        each one with the progress in the report, so big runs don't hold a
+        single transaction and their progress can be followed. As lines
+        are recomputed by difference, running it again after a failure
+        only changes the lines not processed before.
+
+        :param report: List with the report of the models already done.
+        :return: Dictionary with the number of changed agent lines.
+        """
+        lines = self.env[model].search(domain)
+        stats = dict.fromkeys(
+            ('created', 'updated', 'deleted', 'skipped', 'done'), 0)
+        stats['total'] = len(lines)
+        for ids in split_every(max(self.chunk_size, 1), lines.ids):
+            chunk = lines.browse(ids)
+            for key, value in chunk._recompute_agents().items():
+                stats[key] += value
+            stats['done'] += len(ids)
+            chunk.invalidate_cache()
+            self.write({
+                'state': 'running',
+                'report': "\n".join(
+                    report + [self._get_stats_report(model, stats)]),
+            })
+            self._commit()
+            _logger.info(
+                "Recomputing agents of %s: %d/%d", model, stats['done'],
+                stats['total'])
+        return stats
+
+    @api.multi
+    def action_recompute(self):
+        self.ensure_one()
+        report = []
+        for model, domain in self._get_lines_domains().items():
+            stats = self._recompute_lines(model, domain, report)
+            report.append(self._get_stats_report(model, stats))
+        self.write({
+            'state': 'done',
+            'report': "\n".join(report),
+        })
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
@@ -1,7 +1,9 @@
 
-from odoo import models, fields, api, exceptions, _
-from datetime import date, timedelta
-from dateutil.relativedelta import relativedelta
+from collections import OrderedDict
+from itertools import groupby
+
+from odoo import models, fields, api, _
+from odoo.osv import expression
 
 
 class SaleCommissionMakeSettle(models.TransientModel):
@@ -13,48 +15,50 @@ class SaleCommissionMakeSettle(models.TransientModel):
         comodel_name='res.partner',
         domain="[('agent', '=', True)]"
     )
+    workers = fields.Integer(
+        string="Parallel workers",
+        default=1,
+        help="Number of settlement jobs the agents are split into, run in "
+             "parallel by the workers of scheduled actions. A failure in "
+             "one job doesn't undo the settlements of the others.",
+    )
 
     def _get_period_start(self, agent, date_to):
-        if isinstance(date_to, str):
-            date_to = fields.Date.from_string(date_to)
-        if agent.settlement == 'monthly':
-            return date(month=date_to.month, year=date_to.year, day=1)
-        elif agent.settlement == 'quaterly':
-            # Get first month of the date quarter
-            month = (date_to.month - 1) // 3 * 3 + 1
-            return date(month=month, year=date_to.year, day=1)
-        elif agent.settlement == 'semi':
-            if date_to.month > 6:
-                return date(month=7, year=date_to.year, day=1)
-            else:
-                return date(month=1, year=date_to.year, day=1)
-        elif agent.settlement == 'annual':
-            return date(month=1, year=date_to.year, day=1)
-        else:
-            raise exceptions.Warning(_("Settlement period not valid."))
-
-    def _get_next_period_date(self, agent, current_date):
-        if isinstance(current_date, str):
-            current_date = fields.Date.from_string(current_date)
-        if agent.settlement == 'monthly':
-            return current_date + relativedelta(months=1)
-        elif agent.settlement == 'quaterly':
-            return current_date + relativedelta(months=3)
-        elif agent.settlement == 'semi':
-            return current_date + relativedelta(months=6)
-        elif agent.settlement == 'annual':
-            return current_date + relativedelta(years=1)
-        else:
-            raise exceptions.Warning(_("Settlement period not valid."))
+        return self.env['sale.commission.period']._get_period_start(
+            agent.settlement, date_to)
+
+    def _get_settlements_cache(self, keys):
+        """Get with one query the open settlement of each of the given
+        periods, taking the first one if there are several. Hook for reusing
+        other settlements.
 
-    def _get_settlement(self, agent, company, sett_from, sett_to):
-        return self.env['sale.commission.settlement'].search([
-            ('agent', '=', agent.id),
-            ('date_from', '=', sett_from),
-            ('date_to', '=', sett_to),
-            ('company_id', '=', company.id),
-            ('state', '=', 'settled')
-        ], limit=1)
+        :param keys: List of (agent, company, date from, date to) tuples.
+        :return: Dictionary with (agent id, company id, date from, date to)
+          as key and the settlement as value.
+        """
+        if not keys:
+            return {}
+        self.env.cr.execute("""
+            SELECT DISTINCT ON (s.agent, s.company_id, s.date_from,
+                s.date_to) s.id
+            FROM sale_commission_settlement s
+            JOIN unnest(%s::int[], %s::int[], %s::date[], %s::date[])
+                AS k(agent, company_id, date_from, date_to)
+                ON k.agent = s.agent
+                AND k.company_id = s.company_id
+                AND k.date_from = s.date_from
+                AND k.date_to = s.date_to
+            WHERE s.state = 'settled'
+            ORDER BY s.agent, s.company_id, s.date_from, s.date_to, s.id
+        """, (
+            [x[0].id for x in keys], [x[1].id for x in keys],
+            [x[2] for x in keys], [x[3] for x in keys],
+        ))
+        settlements = self.env['sale.commission.settlement'].browse(
+            [x[0] for x in self.env.cr.fetchall()])
+        return {(
+            x.agent.id, x.company_id.id, x.date_from, x.date_to,
+        ): x for x in settlements}
 
     def _prepare_settlement_vals(self, agent, company, sett_from, sett_to):
         return {
@@ -64,53 +68,165 @@ class SaleCommissionMakeSettle(models.TransientModel):
             'company_id': company.id,
         }
 
+    def _get_agent_lines_domain(self, agents, date_to):
+        """Domain for getting the pending lines of all the given agents at
+        once, each one limited to the start of its current period.
+        """
+        agents_by_date = OrderedDict()
+        for agent in agents:
+            date_to_agent = self._get_period_start(agent, date_to)
+            agents_by_date.setdefault(date_to_agent, []).append(agent.id)
+        return expression.AND([
+            [('settled', '=', False)],
+            expression.OR([
+                [('agent', 'in', agent_ids),
+                 ('invoice_date', '<', date_to_agent)]
+                for date_to_agent, agent_ids in agents_by_date.items()
+            ]),
+        ])
+
+    def _get_agent_lines(self, agents, date_to):
+        """Get non settled agent lines of the given agents, sorted for
+        being bucketed by agent, company and period.
+        """
+        if not agents:
+            return self.env['account.invoice.line.agent']
+        return self.env['account.invoice.line.agent'].search(
+            self._get_agent_lines_domain(agents, date_to),
+            order='agent, company_id, invoice_date, id',
+        )
+
+    def _group_agent_lines(self, agent_lines):
+        """Bucket the agent lines by agent, company and settlement period.
+
+        :param agent_lines: Agent lines sorted as `_get_agent_lines` does.
+        :return: Ordered dictionary with (agent, company, date from, date to)
+          as key and the list of agent line ids to settle as value.
+        """
+        groups = OrderedDict()
+        settleable_ids = agent_lines._get_settleable_ids()
+        agent_lines = agent_lines.filtered(lambda x: x.id in settleable_ids)
+        for (agent, company), lines in groupby(
+                agent_lines, key=lambda x: (x.agent, x.company_id)):
+            lines = list(lines)
+            lines_periods = self._get_lines_periods(agent, lines)
+            for line, (sett_from, sett_to) in zip(lines, lines_periods):
+                groups.setdefault(
+                    (agent, company, sett_from, sett_to), [],
+                ).append(line.id)
+        return groups
+
+    def _get_lines_periods(self, agent, lines):
+        """Get the settlement period of each line, mapping the dates of all
+        the lines at once with the settlement period calendar. Hook for
+        settling in other periods.
+
+        :param lines: Agent lines of the agent sorted by invoice date.
+        :return: List of (date from, date to) tuples.
+        """
+        buckets, periods = self.env[
+            'sale.commission.period']._map_dates_to_periods(
+                agent.settlement, [x.invoice_date for x in lines])
+        return [periods[x] for x in buckets]
+
+    def _settle_agent_lines(self, agent_lines, settlements_cache=None):
+        """Create the settlements and settlement lines for the given agent
+        lines, reusing existing open settlements of the same period.
+
+        :param settlements_cache: Optional dictionary as returned by
+          `_get_settlements_cache`, to be reused and updated across several
+          calls. The periods of the given lines missing in it are fetched.
+        :return: Recordset with the settlements that have received lines.
+        """
+        settlement_obj = self.env['sale.commission.settlement']
+        groups = self._group_agent_lines(agent_lines)
+        if settlements_cache is None:
+            settlements_cache = {}
+        settlements_cache.update(self._get_settlements_cache([
+            key for key in groups
+            if (key[0].id, key[1].id, key[2], key[3]) not in settlements_cache
+        ]))
+        settlements = OrderedDict()
+        new_keys = []
+        for key in groups:
+            agent, company, sett_from, sett_to = key
+            settlement = settlements_cache.get(
+                (agent.id, company.id, sett_from, sett_to))
+            if settlement:
+                settlements[key] = settlement
+            else:
+                new_keys.append(key)
+        new_settlements = settlement_obj.create([
+            self._prepare_settlement_vals(*key) for key in new_keys
+        ])
+        for key, settlement in zip(new_keys, new_settlements):
+            settlements[key] = settlement
+            settlements_cache[(
+                key[0].id, key[1].id, key[2], key[3],
+            )] = settlement
+        agent_lines_by_settlement = OrderedDict()
+        for key, line_ids in groups.items():
+            agent_lines_by_settlement.setdefault(
+                settlements[key].id, []).extend(line_ids)
+        self.env['sale.commission.settlement.line']._create_from_agent_lines(
+            agent_lines_by_settlement)
+        return settlement_obj.browse([x.id for x in settlements.values()])
+
+    def _settle_agents(self, agents, date_to):
+        """Settle all the pending commissions of the given agents up to the
+        given date.
+        """
+        return self._settle_agent_lines(
+            self._get_agent_lines(agents, date_to))
+
+    def _create_jobs(self, agents, date_to, workers):
+        """Split the agents in shards, creating a settlement job for each
+        one.
+
+        :return: Recordset with the created jobs.
+        """
+        job_model = self.env['sale.commission.settlement.job']
+        shards = [x for x in (agents[i::workers] for i in range(workers)) if x]
+        return job_model.create([{
+            'date_to': date_to,
+            'agents': [(6, 0, shard.ids)],
+        } for shard in shards])
+
+    @api.multi
+    def action_create_job(self):
+        """Schedule the settlement as a job, processed in chunks by a cron
+        instead of in this request.
+        """
+        self.ensure_one()
+        job = self.env['sale.commission.settlement.job'].create({
+            'date_to': self.date_to,
+            'agents': [(6, 0, self.agents.ids)],
+        })
+        return {
+            'name': _('Settlement job'),
+            'type': 'ir.actions.act_window',
+            'views': [[False, 'form']],
+            'res_model': job._name,
+            'res_id': job.id,
+        }
+
     @api.multi
     def action_settle(self):
         self.ensure_one()
-        agent_line_obj = self.env['account.invoice.line.agent']
-        settlement_obj = self.env['sale.commission.settlement']
-        settlement_line_obj = self.env['sale.commission.settlement.line']
-        settlement_ids = []
         if not self.agents:
             self.agents = self.env['res.partner'].search(
                 [('agent', '=', True)])
-        date_to = self.date_to
-        for agent in self.agents:
-            date_to_agent = self._get_period_start(agent, date_to)
-            # Get non settled invoices
-            agent_lines = agent_line_obj.search(
-                [('invoice_date', '<', date_to_agent),
-                 ('agent', '=', agent.id),
-                 ('settled', '=', False)], order='invoice_date')
-            for company in agent_lines.mapped('company_id'):
-                agent_lines_company = agent_lines.filtered(
-                    lambda r: r.object_id.company_id == company)
-                if not agent_lines_company:
-                    continue
-                pos = 0
-                sett_to = date(year=1900, month=1, day=1)
-                while pos < len(agent_lines_company):
-                    line = agent_lines_company[pos]
-                    pos += 1
-                    if line._skip_settlement():
-                        continue
-                    if line.invoice_date > sett_to:
-                        sett_from = self._get_period_start(
-                            agent, line.invoice_date)
-                        sett_to = self._get_next_period_date(
-                            agent, sett_from,
-                        ) - timedelta(days=1)
-                        settlement = self._get_settlement(
-                            agent, company, sett_from, sett_to)
-                        if not settlement:
-                            settlement = settlement_obj.create(
-                                self._prepare_settlement_vals(
-                                    agent, company, sett_from, sett_to))
-                        settlement_ids.append(settlement.id)
-                    settlement_line_obj.create({
-                        'settlement': settlement.id,
-                        'agent_line': [(6, 0, [line.id])],
-                    })
+        if self.workers > 1:
+            jobs = self._create_jobs(self.agents, self.date_to, self.workers)
+            jobs._schedule()
+            return {
+                'name': _('Settlement jobs'),
+                'type': 'ir.actions.act_window',
+                'views': [[False, 'list'], [False, 'form']],
+                'res_model': jobs._name,
+                'domain': [['id', 'in', jobs.ids]],
+            }
+        settlement_ids = self._settle_agents(self.agents, self.date_to).ids
         # go to results
         if len(settlement_ids):
             return {
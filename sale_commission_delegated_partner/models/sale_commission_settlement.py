@@ -7,8 +7,10 @@ from odoo import models, _
 class SaleCommissionSettlement(models.Model):
     _inherit = 'sale.commission.settlement'
 
-    def _prepare_invoice_header(self, settlement, journal, date=False):
-        vals = super()._prepare_invoice_header(settlement, journal, date=date)
+    def _prepare_invoice_header(self, settlement, journal, date=False,
+                                cache=None):
+        vals = super()._prepare_invoice_header(
+            settlement, journal, date=date, cache=cache)
         if not settlement.agent.delegated_agent_id:
             return vals
         invoice = self.env['account.invoice'].new(vals)
@@ -17,11 +19,13 @@ class SaleCommissionSettlement(models.Model):
         invoice._onchange_journal_id()
         return invoice._convert_to_write(invoice._cache)
 
-    def _prepare_invoice_line(self, settlement, invoice, product):
+    def _prepare_invoice_line(self, settlement, invoice, product,
+                              cache=None):
         invoice_line_vals = super()._prepare_invoice_line(
             settlement,
             invoice,
-            product
+            product,
+            cache=cache,
         )
         if settlement.agent.delegated_agent_id:
             invoice_line_vals["name"] += "\n" + _(
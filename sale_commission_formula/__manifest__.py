@@ -4,7 +4,7 @@
 # License AGPL-3 - See https://www.gnu.org/licenses/agpl-3.0.html
 {
     'name': 'Sale Commission Formula',
-    'version': '12.0.1.1.0',
+    'version': '12.0.1.2.0',
     'category': 'Sale',
     'license': 'AGPL-3',
     'summary': 'Sale commissions computed by formulas',
@@ -14,7 +14,10 @@
         'sale_commission'
     ],
     'data': [
-        'views/sale_commission_view.xml'
+        'security/ir.model.access.csv',
+        'views/sale_commission_view.xml',
+        'views/sale_commission_formula_stats_views.xml',
+        'data/ir_cron_data.xml',
     ],
     'demo': [
         'demo/commission_demo.xml'
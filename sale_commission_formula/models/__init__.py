@@ -1,4 +1,5 @@
 # License AGPL-3 - See https://www.gnu.org/licenses/agpl-3.0.html
 
+from . import formula_stats
 from . import sale_commission
 from . import sale_commission_mixin
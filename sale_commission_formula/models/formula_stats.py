@@ -0,0 +1,166 @@
+# License AGPL-3 - See https://www.gnu.org/licenses/agpl-3.0.html
+
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Seconds between automatic flushes of the counters of each process
+FLUSH_INTERVAL = 60
+# Number of last evaluation times kept per commission for the percentile
+SAMPLES = 200
+
+# Counters of the formula evaluations done by this process, by database
+# and commission id
+_stats = {}
+_last_flush = {}
+_lock = threading.Lock()
+
+
+class FormulaCounters(object):
+    __slots__ = ('invocations', 'total_time', 'errors', 'last_error',
+                 'samples')
+
+    def __init__(self):
+        self.invocations = 0
+        self.total_time = 0.0
+        self.errors = 0
+        self.last_error = None
+        self.samples = deque(maxlen=SAMPLES)
+
+    def p95(self):
+        samples = sorted(self.samples)
+        if not samples:
+            return 0.0
+        return samples[max(int(math.ceil(len(samples) * 0.95)) - 1, 0)]
+
+
+def record_evaluation(dbname, commission_id, lines, duration, error=None):
+    """Add an evaluation of a formula over a number of lines to the
+    counters of the process.
+    """
+    with _lock:
+        counters = _stats.setdefault(dbname, {}).setdefault(
+            commission_id, FormulaCounters())
+        counters.invocations += lines
+        counters.total_time += duration
+        if lines:
+            counters.samples.append(duration / lines)
+        if error is not None:
+            counters.errors += 1
+            counters.last_error = error
+
+
+def pop_counters(dbname, force=False):
+    """Take the counters of the database for flushing them, if they haven't
+    been flushed in the last `FLUSH_INTERVAL` seconds or `force` is set.
+    """
+    now = time.time()
+    with _lock:
+        last_flush = _last_flush.setdefault(dbname, now)
+        if not force and now - last_flush < FLUSH_INTERVAL:
+            return {}
+        _last_flush[dbname] = now
+        return _stats.pop(dbname, {})
+
+
+class SaleCommissionFormulaStats(models.Model):
+    _name = "sale.commission.formula.stats"
+    _description = "Evaluation statistics of commission formulas"
+    _order = "total_time desc"
+    _rec_name = "commission_id"
+
+    commission_id = fields.Many2one(
+        comodel_name="sale.commission", string="Commission", required=True,
+        ondelete="cascade", readonly=True,
+    )
+    invocations = fields.Integer(
+        readonly=True, help="Number of lines evaluated.")
+    total_time = fields.Float(
+        string="Total time (s)", readonly=True, digits=(16, 4))
+    average_time = fields.Float(
+        string="Average time (ms)", readonly=True, digits=(16, 3))
+    p95_time = fields.Float(
+        string="95th percentile (ms)", readonly=True, digits=(16, 3),
+        help="Time per line below which the 95% of the last evaluations done "
+             "by the last flushed worker fall.")
+    errors = fields.Integer(readonly=True)
+    last_error = fields.Text(readonly=True)
+    last_update = fields.Datetime(readonly=True)
+
+    _sql_constraints = [
+        ('commission_uniq', 'unique(commission_id)',
+         'There can only be one statistics record per commission.'),
+    ]
+
+    @api.model
+    def _flush(self, force=False):
+        """Add the counters collected by this process to the statistics.
+
+        They are written with their own cursor, so they are kept even if the
+        current transaction is rolled back, except when testing.
+        """
+        stats = pop_counters(self.env.cr.dbname, force=force)
+        if not stats:
+            return
+        if getattr(threading.currentThread(), 'testing', False):
+            self._write_counters(self.env.cr, stats)
+            return
+        try:
+            with self.pool.cursor() as cr:
+                self._write_counters(cr, stats)
+        except Exception:
+            _logger.warning(
+                "Commission formula statistics couldn't be saved",
+                exc_info=True)
+
+    @api.model
+    def _write_counters(self, cr, stats):
+        for commission_id, counters in stats.items():
+            # Commissions not committed yet are not visible, so skipped
+            cr.execute("""
+                INSERT INTO sale_commission_formula_stats AS s (
+                    commission_id, invocations, total_time, average_time,
+                    p95_time, errors, last_error, last_update,
+                    create_uid, create_date, write_uid, write_date
+                )
+                SELECT id, %(invocations)s, %(total_time)s,
+                    %(total_time)s * 1000 / GREATEST(%(invocations)s, 1),
+                    %(p95)s, %(errors)s, %(last_error)s,
+                    now() at time zone 'UTC', %(uid)s,
+                    now() at time zone 'UTC', %(uid)s,
+                    now() at time zone 'UTC'
+                FROM sale_commission
+                WHERE id = %(commission_id)s
+                ON CONFLICT (commission_id) DO UPDATE SET
+                    invocations = s.invocations + EXCLUDED.invocations,
+                    total_time = s.total_time + EXCLUDED.total_time,
+                    average_time = (s.total_time + EXCLUDED.total_time) *
+                        1000 / GREATEST(
+                            s.invocations + EXCLUDED.invocations, 1),
+                    p95_time = EXCLUDED.p95_time,
+                    errors = s.errors + EXCLUDED.errors,
+                    last_error = COALESCE(
+                        EXCLUDED.last_error, s.last_error),
+                    last_update = EXCLUDED.last_update,
+                    write_uid = EXCLUDED.write_uid,
+                    write_date = EXCLUDED.write_date
+            """, {
+                'commission_id': commission_id,
+                'invocations': counters.invocations,
+                'total_time': counters.total_time,
+                'p95': counters.p95() * 1000,
+                'errors': counters.errors,
+                'last_error': counters.last_error,
+                'uid': self.env.uid,
+            })
+        self.invalidate_cache()
+
+    @api.model
+    def _cron_flush(self):
+        self._flush(force=True)
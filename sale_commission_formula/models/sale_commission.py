@@ -2,7 +2,68 @@
 # © 2016 Davide Corio - Abstract
 # License AGPL-3 - See https://www.gnu.org/licenses/agpl-3.0.html
 
-from odoo import fields, models
+import ast
+
+from odoo import _, api, exceptions, fields, models, tools
+from odoo.tools.safe_eval import _SAFE_OPCODES, test_expr, unsafe_eval
+
+# Line values that can be used in arithmetic expressions, in the order they
+# are passed to the compiled expressions
+FORMULA_FIELDS = (
+    'price_subtotal', 'price_unit', 'discount', 'quantity', 'standard_price',
+)
+FORMULA_FUNCTIONS = {
+    'abs': abs,
+    'max': max,
+    'min': min,
+    'round': round,
+}
+_EXPRESSION_NODES = (
+    ast.Expression, ast.Load, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub,
+    ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.USub, ast.UAdd,
+)
+
+
+def is_arithmetic_expression(expression):
+    """Check if the expression only does arithmetic over the names of
+    `FORMULA_FIELDS` and numbers, with the functions of `FORMULA_FUNCTIONS`.
+    """
+    try:
+        tree = ast.parse(expression.strip(), mode='eval')
+    except SyntaxError:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            if node.id not in FORMULA_FIELDS + tuple(FORMULA_FUNCTIONS):
+                return False
+        elif isinstance(node, ast.Call):
+            if (not isinstance(node.func, ast.Name) or node.keywords or
+                    node.func.id not in FORMULA_FUNCTIONS):
+                return False
+        elif isinstance(node, (ast.Num, getattr(ast, 'Constant', ast.Num))):
+            value = getattr(node, 'value', getattr(node, 'n', None))
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                return False
+        elif not isinstance(node, _EXPRESSION_NODES):
+            return False
+    return True
+
+
+def compile_arithmetic_expression(expression):
+    """Compile an expression checked with `is_arithmetic_expression` into a
+    function receiving the values of `FORMULA_FIELDS`. The function is built
+    from the syntax tree of the expression, so a trailing comment can't
+    break it.
+    """
+    tree = ast.parse(expression.strip(), mode='eval')
+    function = ast.parse(
+        'lambda %s: 0' % ', '.join(FORMULA_FIELDS), mode='eval')
+    function.body.body = tree.body
+    ast.fix_missing_locations(function)
+    # The syntax tree has been fully checked, so it can be compiled as is
+    return unsafe_eval(
+        compile(function, '<commission formula>', 'eval'),
+        {'__builtins__': FORMULA_FUNCTIONS})
 
 
 class SaleCommission(models.Model):
@@ -15,3 +76,72 @@ class SaleCommission(models.Model):
                 "    result = 0\n"
                 "if line._name == 'account.invoice.line':\n"
                 "    result = 0\n")
+    formula_mode = fields.Selection(
+        selection=[("code", "Python code"),
+                   ("expression", "Arithmetic expression")],
+        string="Formula mode", required=True, default="code",
+        help="Python code must put the commission amount in 'result'. An "
+             "expression returns the commission amount directly.",
+    )
+    formula_vectorized = fields.Boolean(
+        string="Computed in batch",
+        compute="_compute_formula_vectorized",
+        store=True,
+        help="The expression only does arithmetic over the line amounts, so "
+             "it's computed for all the lines at once.",
+    )
+
+    @api.depends('formula', 'formula_mode')
+    def _compute_formula_vectorized(self):
+        for commission in self:
+            commission.formula_vectorized = (
+                commission.formula_mode == 'expression' and
+                is_arithmetic_expression(commission.formula or '')
+            )
+
+    @api.multi
+    @api.constrains('commission_type', 'formula', 'formula_mode')
+    def _check_formula(self):
+        for commission in self.filtered(
+                lambda x: x.commission_type == 'formula'):
+            try:
+                commission._compile_formula_code()
+                if (commission.formula_mode == 'expression' and
+                        is_arithmetic_expression(commission.formula or '')):
+                    compile_arithmetic_expression(commission.formula)
+            except (SyntaxError, TypeError, ValueError) as e:
+                raise exceptions.ValidationError(
+                    _("The formula of the commission %s is not valid:\n%s")
+                    % (commission.name, e))
+
+    def _compile_formula_code(self):
+        mode = 'eval' if self.formula_mode == 'expression' else 'exec'
+        return test_expr(self.formula or '', _SAFE_OPCODES, mode=mode)
+
+    @api.multi
+    def _get_formula_code(self):
+        """Get the formula compiled and checked against the allowed opcodes,
+        shared by all the transactions of the process.
+        """
+        self.ensure_one()
+        return self._compile_formula(self.write_date)
+
+    @tools.ormcache('self.id', 'write_date')
+    def _compile_formula(self, write_date):
+        return self._compile_formula_code()
+
+    @api.multi
+    def _get_formula_function(self):
+        """Get a function computing the expression from the values of
+        `FORMULA_FIELDS`, or None if the formula is not a pure arithmetic
+        expression.
+        """
+        self.ensure_one()
+        return self._compile_formula_function(self.write_date)
+
+    @tools.ormcache('self.id', 'write_date')
+    def _compile_formula_function(self, write_date):
+        if (self.formula_mode != 'expression' or
+                not is_arithmetic_expression(self.formula or '')):
+            return None
+        return compile_arithmetic_expression(self.formula)
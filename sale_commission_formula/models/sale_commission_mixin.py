@@ -3,8 +3,25 @@
 # Copyright 2018 Tecnativa - Pedro M. Baeza
 # License AGPL-3 - See https://www.gnu.org/licenses/agpl-3.0.html
 
-from odoo import api, models
-from odoo.tools.safe_eval import safe_eval
+import time
+from collections import OrderedDict
+
+from psycopg2 import OperationalError
+from werkzeug.exceptions import HTTPException
+
+from odoo import api, exceptions, models
+from odoo.tools.safe_eval import _BUILTINS, unsafe_eval
+
+from .formula_stats import record_evaluation
+from .sale_commission import FORMULA_FIELDS
+
+# Exceptions raised as they are when evaluating formulas, as `safe_eval`
+# does, instead of being wrapped in a ValueError
+_EVAL_RERAISED = (
+    exceptions.except_orm, exceptions.RedirectWarning,
+    exceptions.AccessDenied, HTTPException, OperationalError,
+    ZeroDivisionError,
+)
 
 
 class SaleCommissionLineMixin(models.AbstractModel):
@@ -17,6 +34,75 @@ class SaleCommissionLineMixin(models.AbstractModel):
             'self': self,
         }
 
+    def _get_formula_columns(self):
+        """Get the values of `FORMULA_FIELDS` for all the records.
+
+        :return: List with one list of values per field.
+        """
+        lines = [x.object_id for x in self]
+        quantity = (
+            'quantity' if 'quantity' in self.object_id._fields
+            else 'product_uom_qty'
+        )
+        return [
+            [x.price_subtotal for x in lines],
+            [x.price_unit for x in lines],
+            [x.discount for x in lines],
+            [x[quantity] for x in lines],
+            [x.product_id.standard_price for x in lines],
+        ]
+
+    def _eval_commission_formula(self, commission):
+        """Evaluate the formula of the commission for each record of self,
+        compiling it only once. Arithmetic expressions are computed with a
+        compiled function over the values of each record, read for all the
+        records at once.
+
+        The time spent and the errors are added to the statistics of the
+        commission.
+
+        :return: List with the commission amount of each record.
+        """
+        if not isinstance(commission.id, int):
+            return self._eval_commission_formula_lines(commission)
+        dbname = self.env.cr.dbname
+        start = time.time()
+        try:
+            res = self._eval_commission_formula_lines(commission)
+        except Exception as e:
+            record_evaluation(
+                dbname, commission.id, len(self), time.time() - start,
+                error=getattr(e, 'name', False) or str(e))
+            raise
+        record_evaluation(
+            dbname, commission.id, len(self), time.time() - start)
+        self.env['sale.commission.formula.stats']._flush()
+        return res
+
+    def _eval_commission_formula_lines(self, commission):
+        expression = commission.formula_mode == 'expression'
+        if expression:
+            rows = list(zip(*self._get_formula_columns()))
+            function = commission._get_formula_function()
+            if function:
+                return [float(function(*row)) for row in rows]
+        code = commission._get_formula_code()
+        res = []
+        for i, line in enumerate(self):
+            results = line._get_formula_input_dict()
+            if expression:
+                results.update(zip(FORMULA_FIELDS, rows[i]))
+            results['__builtins__'] = _BUILTINS
+            try:
+                value = unsafe_eval(code, results)
+            except _EVAL_RERAISED:
+                raise
+            except Exception as e:
+                raise ValueError('%s: "%s" while evaluating\n%r' % (
+                    type(e), e, commission.formula))
+            res.append(float(value if expression else results['result']))
+        return res
+
     def _get_commission_amount(self, commission, subtotal, product, quantity):
         """Get the commission amount for the data given. To be called by
         compute methods of children models.
@@ -24,10 +110,36 @@ class SaleCommissionLineMixin(models.AbstractModel):
         self.ensure_one()
         if (not product.commission_free and commission and
                 commission.commission_type == 'formula'):
-            formula = commission.formula
-            results = self._get_formula_input_dict()
-            safe_eval(formula, results, mode="exec", nocopy=True)
-            return float(results['result'])
+            return self._eval_commission_formula(commission)[0]
         return super()._get_commission_amount(
             commission, subtotal, product, quantity,
         )
+
+    def _get_commission_amounts(self, values):
+        """Evaluate formula commissions per commission over all its lines,
+        and leave the rest of lines to the generic computation.
+        """
+        groups = OrderedDict()
+        others = []
+        for i, (commission, subtotal, product, quantity) in enumerate(
+                values):
+            if (not product.commission_free and commission and
+                    commission.commission_type == 'formula'):
+                groups.setdefault(commission, []).append(i)
+            else:
+                others.append(i)
+        if not groups:
+            return super()._get_commission_amounts(values)
+        amounts = [0.0] * len(values)
+        for commission, indexes in groups.items():
+            lines = self.browse([self._ids[i] for i in indexes])
+            for i, amount in zip(
+                    indexes, lines._eval_commission_formula(commission)):
+                amounts[i] = amount
+        if others:
+            lines = self.browse([self._ids[i] for i in others])
+            for i, amount in zip(others, super(
+                    SaleCommissionLineMixin, lines,
+            )._get_commission_amounts([values[i] for i in others])):
+                amounts[i] = amount
+        return amounts
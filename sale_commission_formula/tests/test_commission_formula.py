@@ -2,6 +2,7 @@
 # © 2016 Davide Corio - Abstract
 # License AGPL-3 - See https://www.gnu.org/licenses/agpl-3.0.html
 
+from odoo.exceptions import ValidationError
 from odoo.tests.common import TransactionCase
 
 
@@ -67,3 +68,85 @@ class TestCommissionFormula(TransactionCase):
         }).with_context(active_ids=invoice.id).invoice_refund()
         self.assertEqual(-41.25,
                          invoice.refund_invoice_ids[0].commission_total)
+
+    def test_formula_compiled_once(self):
+        code = self.commission._get_formula_code()
+        self.assertIs(self.commission._get_formula_code(), code)
+        self.commission.formula = "result = 1.0"
+        self.assertIsNot(self.commission._get_formula_code(), code)
+
+    def test_formula_checked_on_save(self):
+        with self.assertRaises(ValidationError):
+            self.commission.formula = "result = ("
+        with self.assertRaises(ValidationError):
+            self.commission.formula = "import os\nresult = 0"
+
+    def test_formula_batch(self):
+        self.so_line.agents = False  # Erase current agents
+        agent_line = self.env['sale.order.line.agent'].create({
+            'object_id': self.so_line.id,
+            'agent': self.agent.id,
+            'commission': self.commission.id,
+        })
+        lines = agent_line.browse([agent_line.id] * 3)
+        self.assertEqual(
+            lines._eval_commission_formula(self.commission), [41.25] * 3)
+        self.assertEqual(lines._get_commission_amounts([(
+            self.commission, 0.0, self.so_line.product_id, 1.0,
+        )] * 3), [41.25] * 3)
+
+    def test_formula_expression(self):
+        self.commission.write({
+            'formula_mode': 'expression',
+            'formula': 'price_subtotal * 0.05 + min(quantity, 0)',
+        })
+        self.assertTrue(self.commission.formula_vectorized)
+        self.assertTrue(self.commission._get_formula_function())
+        self.so_line.agents = False  # Erase current agents
+        agent_line = self.env['sale.order.line.agent'].create({
+            'object_id': self.so_line.id,
+            'agent': self.agent.id,
+            'commission': self.commission.id,
+        })
+        self.assertAlmostEqual(agent_line.amount, 37.5)
+        # Comments and line breaks inside parentheses are allowed
+        self.commission.formula = '(price_subtotal *\n 0.05)  # base'
+        self.assertTrue(self.commission.formula_vectorized)
+        self.assertEqual(
+            agent_line._eval_commission_formula(self.commission), [37.5])
+        # Expressions using anything else are evaluated line by line
+        self.commission.formula = 'line.price_subtotal * 0.05 * quantity'
+        self.assertFalse(self.commission.formula_vectorized)
+        self.assertIsNone(self.commission._get_formula_function())
+        self.assertEqual(
+            agent_line._eval_commission_formula(self.commission), [37.5])
+        with self.assertRaises(ValidationError):
+            self.commission.formula = 'result = 1'
+
+    def test_formula_stats(self):
+        stats_model = self.env['sale.commission.formula.stats']
+        stats_model._flush(force=True)
+        self.so_line.agents = False  # Erase current agents
+        agent_line = self.env['sale.order.line.agent'].create({
+            'object_id': self.so_line.id,
+            'agent': self.agent.id,
+            'commission': self.commission.id,
+        })
+        agent_line.browse([agent_line.id] * 3)._eval_commission_formula(
+            self.commission)
+        self.commission.formula = "result = 1 / 0"
+        with self.assertRaises(ZeroDivisionError):
+            agent_line._eval_commission_formula(self.commission)
+        stats_model._flush(force=True)
+        stats = stats_model.search(
+            [('commission_id', '=', self.commission.id)])
+        self.assertEqual(stats.invocations, 4)
+        self.assertEqual(stats.errors, 1)
+        self.assertIn('division', stats.last_error)
+        self.assertGreaterEqual(stats.p95_time, 0.0)
+        # Next flushes are added
+        self.commission.formula = "result = 1.0"
+        agent_line._eval_commission_formula(self.commission)
+        stats_model._flush(force=True)
+        self.assertEqual(stats.invocations, 5)
+        self.assertEqual(stats.errors, 1)
@@ -1,5 +1,6 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+from . import sale_commission_mixin
 from . import account_invoice
 from . import res_partner
 from . import sale_order
@@ -17,11 +17,5 @@ class AccountInvoiceLine(models.Model):
             if not self and vals.get("invoice_id"):
                 invoice = self.env["account.invoice"].browse(vals["invoice_id"])
                 partner = invoice.user_id.partner_id
-            if partner.agent and partner.salesman_as_agent:
-                res = [
-                    (0, 0, {
-                        'agent': partner.id,
-                        'commission': partner.commission.id,
-                    }),
-                ]
+            res = self._prepare_agents_vals_salesman(partner)
         return res
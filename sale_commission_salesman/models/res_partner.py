@@ -14,6 +14,10 @@ class ResPartner(models.Model):
              "added as the commission agent",
     )
 
+    @api.model
+    def _get_agents_memo_fields(self):
+        return super()._get_agents_memo_fields() | {"salesman_as_agent"}
+
     @api.constrains("salesman_as_agent", "commission")
     def _check_salesman_as_agent(self):
         for record in self:
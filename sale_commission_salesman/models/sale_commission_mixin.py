@@ -0,0 +1,32 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import api, models
+
+from odoo.addons.sale_commission.models.sale_commission_mixin import (
+    get_partner_agents_memo,
+)
+
+
+class SaleCommissionMixin(models.AbstractModel):
+    _inherit = 'sale.commission.mixin'
+
+    @api.model
+    def _prepare_agents_vals_salesman(self, partner):
+        """Get the agent values for the salesman partner if it's configured
+        as agent, memoized as the agents of the partners.
+        """
+        memo = get_partner_agents_memo(self.env.cr)
+        key = ('salesman', self.env.uid, partner.id)
+        if memo is not None and key in memo:
+            agents = memo[key]
+        else:
+            agents = (
+                ((partner.id, partner.commission.id), )
+                if partner.agent and partner.salesman_as_agent else ()
+            )
+            if memo is not None:
+                memo[key] = agents
+        return [(0, 0, {
+            'agent': agent_id,
+            'commission': commission_id,
+        }) for agent_id, commission_id in agents]
@@ -17,11 +17,5 @@ class SaleOrdeLine(models.Model):
             if not self and vals.get("order_id"):
                 order = self.env["sale.order"].browse(vals["order_id"])
                 partner = order.user_id.partner_id
-            if partner.agent and partner.salesman_as_agent:
-                res = [
-                    (0, 0, {
-                        'agent': partner.id,
-                        'commission': partner.commission.id,
-                    }),
-                ]
+            res = self._prepare_agents_vals_salesman(partner)
         return res
@@ -4,6 +4,10 @@
 from odoo import exceptions
 from odoo.tests.common import SavepointCase
 
+from odoo.addons.sale_commission.models.sale_commission_mixin import (
+    PARTNER_AGENTS_MEMO,
+)
+
 
 class TestSaleCommissionSalesman(SavepointCase):
 
@@ -106,3 +110,14 @@ class TestSaleCommissionSalesman(SavepointCase):
         })
         self.assertTrue(len(line.agents), 1)
         self.assertTrue(line.agents.agent, self.other_agent)
+
+    def test_salesman_agent_memo(self):
+        line_model = self.env['sale.order.line']
+        self.env.cr.cache.pop(PARTNER_AGENTS_MEMO, None)
+        self.assertEqual(
+            len(line_model._prepare_agents_vals_salesman(self.agent)), 1)
+        self.assertIn(
+            ('salesman', self.env.uid, self.agent.id),
+            self.env.cr.cache[PARTNER_AGENTS_MEMO])
+        self.agent.salesman_as_agent = False
+        self.assertFalse(line_model._prepare_agents_vals_salesman(self.agent))